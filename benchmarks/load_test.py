@@ -0,0 +1,299 @@
+"""Load test and latency benchmark for the model server
+Starts the app locally, or targets a running server with --url, drives the endpoints
+at a fixed concurrency and optional request rate and reports throughput, latency
+percentiles and error rate per endpoint. Run from the repository root:
+    python benchmarks/load_test.py --stub --concurrency 16 --requests 500
+"""
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+import requests
+from PIL import Image
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+
+ENDPOINTS = ["qa", "sentiment_analysis", "text_generation", "classify_image", "change_classes"]
+
+QA_CONTEXT = ("Stockholm is the capital and largest city of Sweden. It is spread over "
+              "fourteen islands where lake Malaren meets the Baltic Sea.")
+SENTIMENT_TEXT = "The package arrived on time and works as expected"
+TEXT_PROMPT = "The weather in Stockholm today is"
+IMAGE_LABELS = ["cat", "dog", "banana"]
+
+RESULT_COLUMNS = ["endpoint", "requests", "errors", "error_rate", "duration_s", "throughput_rps",
+                  "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+
+
+def _image_bytes() -> bytes:
+    "A small JPEG made here so no image files are needed"
+    image = Image.new("RGB", (320, 240), (30, 120, 200))
+    image.paste(Image.new("RGB", (160, 120), (230, 220, 40)), (80, 60))
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+IMAGE = _image_bytes()
+
+
+def build_request(endpoint: str, index: int, unique: bool) -> tuple:
+    """Builds the request for one call to an endpoint
+
+    Args:
+        endpoint (str): One of ENDPOINTS
+        index (int): Number of the request, makes the input unique
+        unique (bool): Makes every input different so the result cache does not answer
+
+    Returns:
+        tuple: method, path and keyword arguments for requests
+    """
+    suffix = f" {index}" if unique else ""
+    if endpoint == "qa":
+        return "POST", "/qa/", {"json": {"question": "What is the capital of Sweden?" + suffix,
+                                         "context": QA_CONTEXT}}
+    if endpoint == "sentiment_analysis":
+        return "POST", "/sentiment_analysis/", {"json": {"context": SENTIMENT_TEXT + suffix}}
+    if endpoint == "text_generation":
+        return "POST", "/text_generation/", {"json": {"context": TEXT_PROMPT + suffix}}
+    if endpoint == "classify_image":
+        # bytes after the JPEG end marker change the hash but not the decoded image
+        image = IMAGE + (index.to_bytes(8, "big") if unique else b"")
+        return "POST", "/classify_image/", {"files": {"file": ("image.jpg", image, "image/jpeg")},
+                                            "data": {"labels": IMAGE_LABELS}}
+    if endpoint == "change_classes":
+        return "PUT", "/change_classes/", {"json": {"labels": IMAGE_LABELS}}
+    raise ValueError(f"unknown endpoint {endpoint}")
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest rank percentile
+
+    Args:
+        values (list): Sorted values
+        p (float): Percentile between 0 and 100
+
+    Returns:
+        float: The value at the percentile, 0 for no values
+    """
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def summarize(endpoint: str, latencies: list, errors: int, duration: float) -> dict:
+    """Summarizes the latencies of one endpoint run
+
+    Args:
+        endpoint (str): Name of the endpoint
+        latencies (list): Latency of every request in seconds
+        errors (int): Requests that failed or got an error status
+        duration (float): Wall time of the run in seconds
+
+    Returns:
+        dict: One row with the columns in RESULT_COLUMNS
+    """
+    latencies = sorted(latency * 1000 for latency in latencies)
+    total = len(latencies)
+    return {"endpoint": endpoint,
+            "requests": total,
+            "errors": errors,
+            "error_rate": round(errors / total, 4) if total else 0.0,
+            "duration_s": round(duration, 3),
+            "throughput_rps": round(total / duration, 2) if duration else 0.0,
+            "mean_ms": round(sum(latencies) / total, 2) if total else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "max_ms": round(latencies[-1], 2) if total else 0.0}
+
+
+def run_endpoint(base_url: str, endpoint: str, total: int, duration: float, concurrency: int,
+                 rate: float, unique: bool, timeout: float) -> dict:
+    """Drives one endpoint until total requests are sent or duration has passed
+
+    With a rate the requests are sent on a fixed schedule and latency is measured
+    from the scheduled time, so time queued behind slow requests is counted
+
+    Args:
+        base_url (str): Address of the server
+        endpoint (str): One of ENDPOINTS
+        total (int): Number of requests, 0 runs for duration
+        duration (float): Max seconds to run, 0 sends total requests
+        concurrency (int): Requests in flight at once
+        rate (float): Requests per second, 0 sends as fast as the concurrency allows
+        unique (bool): Makes every input different so the result cache does not answer
+        timeout (float): Seconds before a request counts as failed
+
+    Returns:
+        dict: Summary of the run
+    """
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    counter = [0]
+    start = time.perf_counter()
+    deadline = start + duration if duration else float("inf")
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                index = counter[0]
+                counter[0] += 1
+            if total and index >= total:
+                break
+            scheduled = start + index / rate if rate else time.perf_counter()
+            if scheduled >= deadline or time.perf_counter() >= deadline:
+                break
+            time.sleep(max(0.0, scheduled - time.perf_counter()))
+            method, path, kwargs = build_request(endpoint, index, unique)
+            try:
+                response = session.request(method, base_url + path, timeout=timeout, **kwargs)
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            latency = time.perf_counter() - scheduled
+            with lock:
+                latencies.append(latency)
+                errors[0] += failed
+        session.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(endpoint, latencies, errors[0], time.perf_counter() - start)
+
+
+def warm_up(base_url: str, endpoint: str, timeout: float):
+    "Sends one untimed request so model loading is not part of the latencies"
+    method, path, kwargs = build_request(endpoint, -1, False)
+    try:
+        requests.request(method, base_url + path, timeout=timeout, **kwargs)
+    except requests.RequestException:
+        pass
+
+
+def start_local_server(port: int, stub: bool):
+    """Imports the app from ./src and serves it from a background thread
+
+    Args:
+        port (int): Port to listen on
+        stub (bool): Serves the fake models in stub_models.py instead of the real ones
+
+    Returns:
+        uvicorn.Server: The running server
+    """
+    sys.path.insert(0, SRC_DIR)
+    if stub:
+        sys.path.insert(0, BENCHMARK_DIR)
+        import stub_models
+        sys.modules["models"] = stub_models
+    import main
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def _git_commit() -> str:
+    "Commit of the benchmarked code, empty outside a git checkout"
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def write_results(output_dir: str, settings: dict, results: list) -> str:
+    """Writes the run as json with the settings and as csv with one row per endpoint
+
+    Args:
+        output_dir (str): Directory for the result files
+        settings (dict): Settings of the run
+        results (list): Summaries from run_endpoint
+
+    Returns:
+        str: Path of the files without extension
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, "load_test-" + datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(path + ".json", "w") as json_file:
+        json.dump({"settings": settings, "results": results}, json_file, indent=2)
+    with open(path + ".csv", "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("endpoints", nargs="*", default=ENDPOINTS,
+                        help=f"endpoints to drive, default all of {', '.join(ENDPOINTS)}")
+    parser.add_argument("--url", default="", help="target a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8765, help="port of the local server")
+    parser.add_argument("--stub", action="store_true", help="serve fake models, no weights are downloaded")
+    parser.add_argument("--stub-latency-ms", type=float, default=20, help="simulated forward pass time")
+    parser.add_argument("--stub-item-ms", type=float, default=2, help="simulated extra time per batch item")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second, 0 is unlimited")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint, 0 runs for --duration")
+    parser.add_argument("--duration", type=float, default=0, help="max seconds per endpoint, 0 is unlimited")
+    parser.add_argument("--repeat-inputs", action="store_true",
+                        help="send the same input every time to measure result cache hits")
+    parser.add_argument("--no-warm-up", action="store_true",
+                        help="also time the first request, which loads the model")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before a request fails")
+    parser.add_argument("--output-dir", default=os.path.join(BENCHMARK_DIR, "results"),
+                        help="directory for the json and csv result files")
+    args = parser.parse_args()
+    unknown = [name for name in args.endpoints if name not in ENDPOINTS]
+    if unknown:
+        parser.error(f"unknown endpoints {unknown}")
+    if not args.requests and not args.duration:
+        parser.error("set --requests or --duration")
+
+    server = None
+    base_url = args.url.rstrip("/")
+    if not base_url:
+        if args.stub:
+            sys.path.insert(0, BENCHMARK_DIR)
+            import stub_models
+            stub_models.configure(args.stub_latency_ms, args.stub_item_ms)
+        server = start_local_server(args.port, args.stub)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    settings = {key: value for key, value in vars(args).items() if key != "output_dir"}
+    settings.update({"base_url": base_url, "git_commit": _git_commit(),
+                     "started": datetime.now().isoformat(timespec="seconds")})
+    results = []
+    try:
+        for endpoint in args.endpoints:
+            if not args.no_warm_up:
+                warm_up(base_url, endpoint, args.timeout)
+            result = run_endpoint(base_url, endpoint, args.requests, args.duration, args.concurrency,
+                                  args.rate, not args.repeat_inputs, args.timeout)
+            print(" ".join(f"{column}={result[column]}" for column in RESULT_COLUMNS))
+            results.append(result)
+    finally:
+        if server is not None:
+            server.should_exit = True
+    print("Results written to", write_results(args.output_dir, settings, results) + ".{json,csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Fake models with the same methods as ./src/models.py
+They sleep instead of running a model so the serving overhead of the
+server can be measured without downloading weights
+"""
+import time
+import numpy as np
+
+# simulated cost of one forward pass and of each extra item in a batch
+LATENCY_S = 0.02
+ITEM_LATENCY_S = 0.002
+
+
+def configure(latency_ms: float, item_latency_ms: float):
+    """Sets the simulated model latency
+
+    Args:
+        latency_ms (float): Milliseconds for one forward pass
+        item_latency_ms (float): Extra milliseconds per item in a batch
+    """
+    global LATENCY_S, ITEM_LATENCY_S
+    LATENCY_S = latency_ms / 1000
+    ITEM_LATENCY_S = item_latency_ms / 1000
+
+
+def _forward(items: int = 1):
+    "Sleeps like a batched forward pass would take"
+    time.sleep(LATENCY_S + ITEM_LATENCY_S * (items - 1))
+
+
+class QA:
+    checkpoint = "stub-qa"
+
+    def __init__(self, quantized=False, **kwargs):
+        self.quantized = quantized
+
+    def answer_question(self, question: str, context: str) -> dict:
+        return self.answer_questions([question], [context])[0]
+
+    def answer_questions(self, questions: list, contexts: list) -> list:
+        _forward(len(questions))
+        return [{"score": 0.5, "start": 0, "end": len(context.split(" ")[0]),
+                 "answer": context.split(" ")[0]} for context in contexts]
+
+    def answer_questions_about(self, context: str, questions: list, doc_stride=None, batch_size=16) -> list:
+        return self.answer_questions(questions, [context] * len(questions))
+
+
+class TextGenerator:
+    checkpoint = "stub-text-generator"
+
+    def __init__(self, quantized=False, **kwargs):
+        self.quantized = quantized
+
+    def generate_text(self, context: str, min_length=50, max_length=500) -> list:
+        return [{"generated_text": context + "".join(self.stream_text(context, min_length, max_length))}]
+
+    def stream_text(self, context: str, min_length=50, max_length=500, top_k=50):
+        for _ in range(max(1, min_length - len(context.split()))):
+            _forward()
+            yield " token"
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class SentimentAnalyser:
+    checkpoint = "stub-sentiment"
+
+    def __init__(self, quantized=False, **kwargs):
+        self.quantized = quantized
+
+    def analyse_text(self, text: str) -> list:
+        return self.analyse_texts([text])
+
+    def analyse_texts(self, texts: list) -> list:
+        _forward(len(texts))
+        return [{"label": "POSITIVE" if len(text) % 2 else "NEGATIVE", "score": 0.9} for text in texts]
+
+
+class ImageClassifier:
+    checkpoint = "stub-image-classifier"
+
+    def __init__(self, labels=['cat', 'dog', 'banana'], quantized=False, **kwargs):
+        self.labels = labels
+        self.quantized = quantized
+
+    def classify(self, image, labels=None) -> dict:
+        return self.classify_batch([image], [labels])[0]
+
+    def classify_batch(self, images: list, labels_list: list, return_embeddings=False):
+        _forward(len(images))
+        embeds = np.full((len(images), 512), 512 ** -0.5, dtype=np.float32)
+        results = self.classify_embeddings(embeds, labels_list)
+        return (results, embeds) if return_embeddings else results
+
+    def classify_embeddings(self, image_embeds, labels_list: list) -> list:
+        return [{label: 1 / len(labels or self.labels) for label in labels or self.labels}
+                for labels in labels_list]
+
+    def score_embedding(self, embedding, labels=None) -> dict:
+        if len(embedding) != 512:
+            raise ValueError("Embedding must have 512 values.")
+        return self.classify_embeddings([embedding], [labels])[0]
+
+    def text_embedding(self, text: str):
+        _forward(1)
+        return np.full(512, 512 ** -0.5, dtype=np.float32)
+
+    def change_labels(self, new_labels: list):
+        self.labels = new_labels
+
+    def get_labels(self) -> list:
+        return self.labels
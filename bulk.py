@@ -0,0 +1,375 @@
+"""Bulk inference over CSV and JSONL files and image directories
+Streams the input through the machine learning server in chunks with a few
+requests in flight, stores the results in the database and in an output file
+and keeps a checkpoint, so an interrupted run continues where it stopped.
+Items the server could not process are written to the output with their error.
+    python bulk.py sentiment reviews.csv --column text
+    python bulk.py qa questions.jsonl --output answers.jsonl
+    python bulk.py images ./photos --labels cat dog --in-flight 2
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sqlite3
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from utilities import DatabaseEngine, MLClient, MLImageClassifier, MLQA, MLSentimentAnalysis
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# progress of the runs that write to the database, committed together with their results
+_PROGRESS_TABLE_CREATE_COMMAND = """CREATE TABLE IF NOT EXISTS bulk_progress(
+                                    checkpoint TEXT PRIMARY KEY,
+                                    task TEXT NOT NULL,
+                                    input TEXT NOT NULL,
+                                    done INTEGER NOT NULL,
+                                    output_bytes INTEGER NOT NULL)"""
+
+
+def read_records(path: str):
+    """Reads the rows of a CSV file or the objects of a JSONL file one at a time
+
+    Args:
+        path (str): .csv file, any other file is read as JSONL
+
+    Yields:
+        dict: one row
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as records:
+            yield from csv.DictReader(records)
+    else:
+        with open(path, encoding="utf-8") as records:
+            for line in records:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def read_images(directory: str):
+    """Lists the images below a directory in a stable order, one directory at a time
+
+    Args:
+        directory (str): image directory
+
+    Yields:
+        tuple: path relative to the directory and full path
+    """
+    for root, directories, files in os.walk(directory):
+        directories.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, directory), path
+
+
+def _field(record: dict, column: str, number: int) -> str:
+    "Value of a column, an error names the row when it is missing"
+    if column not in record:
+        raise ValueError(f"Row {number} has no column {column!r}")
+    return record[column]
+
+
+def sentiment_items(args):
+    for number, record in enumerate(read_records(args.input), 1):
+        yield _field(record, args.column, number)
+
+
+def qa_items(args):
+    for number, record in enumerate(read_records(args.input), 1):
+        yield _field(record, args.question_column, number), _field(record, args.context_column, number)
+
+
+def image_items(args):
+    return read_images(args.input)
+
+
+def run_sentiment(chunk: list, args, client: MLClient) -> list:
+    model = MLSentimentAnalysis(app=args.app, client=client)
+    return model.analyse_sentiment_batch(chunk, len(chunk))
+
+
+def run_qa(chunk: list, args, client: MLClient) -> list:
+    questions, contexts = zip(*chunk)
+    model = MLQA(app=args.app, client=client)
+    return model.question_answering_batch(list(questions), list(contexts), len(chunk))
+
+
+def run_images(chunk: list, args, client: MLClient) -> list:
+    # images are read here so only the chunks in flight are in memory
+    images = []
+    unreadable = {}
+    for name, path in chunk:
+        try:
+            with open(path, "rb") as image:
+                images.append((name, image.read()))
+        except OSError as error:
+            unreadable[name] = str(error)
+    model = MLImageClassifier(app=args.app, client=client)
+    outs = iter(model.classify_image_batch(images, args.labels, len(images)) if images else [])
+    return [{"date": str(datetime.now()),
+             "filename": name,
+             "modeltype": model.modeltype,
+             "result": unreadable[name],
+             "error": unreadable[name]} if name in unreadable else next(outs)
+            for name, _ in chunk]
+
+
+def _run_chunk(run_chunk, chunk: list, args, client: MLClient) -> list:
+    """Runs one chunk, with --skip-errors a chunk the server failed is run
+    again one item at a time so only the failing items are lost
+
+    Returns:
+        list: one output dictionary per item, error is None, the reason the
+              server gave or ConnectionError
+    """
+    outs = run_chunk(chunk, args, client)
+    if args.skip_errors and len(chunk) > 1 and any(out["result"] == "ConnectionError" for out in outs):
+        outs = [out for item in chunk for out in run_chunk([item], args, client)]
+    for out in outs:
+        out.setdefault("error", "ConnectionError" if out["result"] == "ConnectionError" else None)
+    return outs
+
+
+# model class, input reader, request function, chunk size and output columns per task
+TASKS = {
+    "sentiment": (MLSentimentAnalysis, sentiment_items, run_sentiment, 256,
+                  ("date", "context", "result", "score", "error")),
+    "qa": (MLQA, qa_items, run_qa, 64,
+           ("date", "question", "context", "result", "score", "error")),
+    "images": (MLImageClassifier, image_items, run_images, 16,
+               ("date", "filename", "result", "error")),
+}
+
+
+class Checkpoint():
+    """Progress of a run: items done and the size of the output file after them.
+    With a database the progress is also kept in it, committed together with
+    the results, and that copy is the one a resumed run continues from
+    Methods: __init__
+            load
+            progress_statement
+            save
+            remove
+    """
+    def __init__(self, path: str, task: str, input_path: str, engine: DatabaseEngine = None) -> None:
+        """Initializes class
+
+        Args:
+            path (str): checkpoint file
+            task (str): task of the run
+            input_path (str): input of the run
+            engine (DatabaseEngine, optional): database the results are written to. Defaults to None.
+        """
+        self.path = path
+        self.task = task
+        self.input_path = os.path.abspath(input_path)
+        self.engine = engine
+        self.key = os.path.abspath(path)
+        self.done = 0
+        self.output_bytes = 0
+        if engine is not None:
+            engine.write_batch([], [(_PROGRESS_TABLE_CREATE_COMMAND, ())])
+
+    def load(self) -> bool:
+        """Reads the checkpoint of an earlier run
+
+        Returns:
+            bool: True if there was one
+        """
+        state = None
+        if self.engine is not None:
+            rows = self.engine.query("""SELECT task, input, done, output_bytes FROM bulk_progress
+                                        WHERE checkpoint = ?""", (self.key,))
+            if rows:
+                state = dict(zip(("task", "input", "done", "output_bytes"), rows[0]))
+        if state is None:
+            try:
+                with open(self.path) as checkpoint:
+                    state = json.load(checkpoint)
+            except FileNotFoundError:
+                return False
+        if (state["task"], state["input"]) != (self.task, self.input_path):
+            raise ValueError(f"{self.path} belongs to {state['task']} over {state['input']}, "
+                             "use --fresh or another --checkpoint")
+        self.done = state["done"]
+        self.output_bytes = state["output_bytes"]
+        return True
+
+    def progress_statement(self, done: int, output_bytes: int) -> tuple:
+        """Statement that records the progress in the database
+
+        Args:
+            done (int): items done
+            output_bytes (int): size of the output file after them
+
+        Returns:
+            tuple: sql and parameters for DatabaseEngine.write_batch
+        """
+        return ("""INSERT OR REPLACE INTO bulk_progress (checkpoint, task, input, done, output_bytes)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (self.key, self.task, self.input_path, done, output_bytes))
+
+    def save(self):
+        "Replaces the checkpoint file in one step so an interruption never leaves half of it"
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as checkpoint:
+            json.dump({"task": self.task,
+                       "input": self.input_path,
+                       "done": self.done,
+                       "output_bytes": self.output_bytes}, checkpoint)
+        os.replace(temporary, self.path)
+
+    def remove(self):
+        "Removes the checkpoint when the run is complete"
+        if self.engine is not None:
+            self.engine.write_batch([], [("DELETE FROM bulk_progress WHERE checkpoint = ?", (self.key,))])
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _encode_rows(outs: list, columns: tuple, as_csv: bool) -> bytes:
+    "Output file lines of the results, columns in the same form as in the database"
+    rows = [{column: out.get(column) for column in columns} for out in outs]
+    if not as_csv:
+        return "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+    text = io.StringIO()
+    csv.DictWriter(text, columns).writerows(rows)
+    return text.getvalue().encode("utf-8")
+
+
+def _open_output(path: str, size: int, columns: tuple, as_csv: bool):
+    "Opens the output file cut back to the checkpointed size, lines of an unfinished chunk are dropped"
+    if size and (not os.path.exists(path) or os.path.getsize(path) < size):
+        raise ValueError(f"{path} is shorter than its checkpoint, use --fresh to start over")
+    output = open(path, "r+b" if size else "wb")
+    output.truncate(size)
+    output.seek(size)
+    if as_csv and not size:
+        header = io.StringIO()
+        csv.writer(header).writerow(columns)
+        output.write(header.getvalue().encode("utf-8"))
+    return output
+
+
+def run(args) -> int:
+    """Runs the bulk inference
+
+    Returns:
+        int: exit code, 1 if a chunk failed and the run can be resumed
+    """
+    model_class, read_items, run_chunk, default_chunk_size, columns = TASKS[args.task]
+    chunk_size = args.chunk_size or default_chunk_size
+    output_path = args.output or os.path.splitext(os.path.basename(args.input.rstrip(os.sep)))[0] + \
+        f".{args.task}.jsonl"
+    as_csv = output_path.lower().endswith(".csv")
+    engine = DatabaseEngine(args.db) if args.db else None
+    try:
+        checkpoint = Checkpoint(args.checkpoint or output_path + ".checkpoint", args.task, args.input, engine)
+        if args.fresh:
+            checkpoint.remove()
+        elif checkpoint.load():
+            print(f"Resuming after {checkpoint.done} items", file=sys.stderr)
+
+        client = MLClient(pool_size=max(10, args.in_flight))
+        model = model_class(app=args.app, client=client)
+        if not model.wait_until_ready(args.start_timeout) or model.start() == "Error":
+            print("The model did not start on the ml server", file=sys.stderr)
+            return 1
+
+        items = itertools.islice(read_items(args), checkpoint.done, None)
+        chunks = iter(lambda: list(itertools.islice(items, chunk_size)), [])
+        code = _run_chunks(chunks, run_chunk, args, client, engine, checkpoint, columns, output_path, as_csv)
+        if not code:
+            checkpoint.remove()
+    finally:
+        if engine is not None:
+            engine.close()
+    if code:
+        print("Run the same command again to resume", file=sys.stderr)
+    else:
+        print(f"Wrote {checkpoint.done} results to {output_path}", file=sys.stderr)
+    return code
+
+
+def _run_chunks(chunks, run_chunk, args, client: MLClient, engine: DatabaseEngine,
+                checkpoint: Checkpoint, columns: tuple, output_path: str, as_csv: bool) -> int:
+    """Sends the chunks with --in-flight requests at a time and writes the results in input order
+
+    Returns:
+        int: exit code, 1 if a chunk failed
+    """
+    output = _open_output(output_path, checkpoint.output_bytes, columns, as_csv)
+    code = 0
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.in_flight) as pool:
+            pending = deque()
+            for chunk in itertools.chain(chunks, [None] * args.in_flight):
+                if chunk is not None:
+                    pending.append((len(chunk), pool.submit(_run_chunk, run_chunk, chunk, args, client)))
+                if not pending or (chunk is not None and len(pending) < args.in_flight):
+                    continue
+                # results are written in input order so the checkpoint is one number
+                count, future = pending.popleft()
+                outs = future.result()
+                if not args.skip_errors and any(out["error"] == "ConnectionError" for out in outs):
+                    code = 1
+                    print(f"The ml server failed after {checkpoint.done} items, "
+                          "--skip-errors records the failing items and goes on", file=sys.stderr)
+                    for _, future in pending:
+                        future.cancel()
+                    break
+                output.write(_encode_rows(outs, columns, as_csv))
+                output.flush()
+                done, output_bytes = checkpoint.done + count, output.tell()
+                if engine is not None:
+                    # the results and the progress are one transaction, a resumed run
+                    # never inserts a chunk twice
+                    engine.write_batch([out for out in outs if out["error"] is None],
+                                       [checkpoint.progress_statement(done, output_bytes)])
+                checkpoint.done, checkpoint.output_bytes = done, output_bytes
+                checkpoint.save()
+                failed += sum(out["error"] is not None for out in outs)
+                print(f"{checkpoint.done} items done, {failed} failed", file=sys.stderr)
+    except (ValueError, sqlite3.Error) as error:
+        print(f"Stopped after {checkpoint.done} items: {error}", file=sys.stderr)
+        code = 1
+    finally:
+        output.close()
+    return code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("task", choices=sorted(TASKS), help="model to run")
+    parser.add_argument("input", help="CSV or JSONL file, a directory of images for images")
+    parser.add_argument("--column", default="text", help="sentiment: column with the text")
+    parser.add_argument("--question-column", default="question", help="qa: column with the question")
+    parser.add_argument("--context-column", default="context", help="qa: column with the context")
+    parser.add_argument("--labels", nargs="*", default=None, help="images: classes, default the server classes")
+    parser.add_argument("--output", default="", help="JSONL or .csv output, default <input>.<task>.jsonl")
+    parser.add_argument("--db", default="main_database.db", help="sqlite database, empty to skip")
+    parser.add_argument("--checkpoint", default="", help="checkpoint file, default <output>.checkpoint")
+    parser.add_argument("--fresh", action="store_true", help="ignore the checkpoint and start over")
+    parser.add_argument("--skip-errors", action="store_true",
+                        help="record the items the server fails on as errors instead of stopping")
+    parser.add_argument("--chunk-size", type=int, default=0, help="items per request, default per task")
+    parser.add_argument("--in-flight", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--app", default="http://localhost:8000", help="machine learning server")
+    parser.add_argument("--start-timeout", type=float, default=60, help="seconds to wait for the server")
+    args = parser.parse_args()
+    if args.chunk_size < 0 or args.in_flight < 1:
+        parser.error("--chunk-size can not be negative and --in-flight must be at least 1")
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Micro batching of inference requests, single requests are queued for a
+few milliseconds and run through the model together in one forward pass
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Collects submitted items into batches for a batch function
+    Methods: __init__
+            submit
+            submit_many
+            stats
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 8, max_wait_ms: float = 5,
+                 executor=None, max_concurrent_batches: int = 1):
+        """Constructor of the batcher
+
+        Args:
+            batch_fn (callable): Takes a list of items and returns a list of results in the same order
+            max_batch_size (int, optional): Max items in one batch. Defaults to 8.
+            max_wait_ms (float, optional): Max time the first item in a batch waits for more items.
+                                           Defaults to 5.
+            executor (InferenceExecutor, optional): Runs the batches so the next batch can be
+                                                    collected meanwhile. Defaults to None,
+                                                    batches run in the collecting thread.
+            max_concurrent_batches (int, optional): Batches running at once, new requests wait
+                                                    in the queue and form a larger batch
+                                                    meanwhile. Defaults to 1.
+        """
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(self.max_concurrent_batches)
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = {}
+        self._items = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, item) -> Future:
+        """Queues one item for the next batch
+
+        Args:
+            item: Input for the batch function
+
+        Returns:
+            Future: Resolves to the result for this item
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.monotonic()))
+        return future
+
+    def submit_many(self, items: list) -> list:
+        """Queues several items, they are split over batches of max_batch_size
+
+        Args:
+            items (list): Inputs for the batch function
+
+        Returns:
+            list: One future per item in the same order
+        """
+        return [self.submit(item) for item in items]
+
+    def _ensure_started(self):
+        "Starts the collecting thread, again after a fork as threads are not copied"
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._slots = threading.Semaphore(self.max_concurrent_batches)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._collect, daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        "Waits for a first item then fills the batch until it is full or the wait is over"
+        while True:
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0
+                                 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.executor is None:
+                self._run_batch(batch)
+                self._slots.release()
+            else:
+                running = self.executor.submit(self._run_batch, batch)
+                running.add_done_callback(lambda _: self._slots.release())
+
+    def _run_batch(self, batch: list):
+        """Runs one batch and hands each result to its future, a failed batch
+        runs again one item at a time so only the failing items get the exception"""
+        batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.monotonic()
+        self._record(len(batch), [started - entry[2] for entry in batch])
+        try:
+            results = self.batch_fn([entry[0] for entry in batch])
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+                return
+            for entry in batch:
+                try:
+                    entry[1].set_result(self.batch_fn([entry[0]])[0])
+                except Exception as item_error:
+                    entry[1].set_exception(item_error)
+            return
+        for entry, result in zip(batch, results):
+            entry[1].set_result(result)
+
+    def _record(self, size: int, waits: list):
+        "Updates the batch size and queue wait statistics"
+        with self._stats_lock:
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+            self._items += size
+            self._wait_total += sum(waits)
+            self._wait_max = max([self._wait_max] + waits)
+
+    def stats(self) -> dict:
+        """Reports batch sizes and queue wait times
+
+        Returns:
+            dict: Settings, counters, batch size histogram and wait times
+        """
+        with self._stats_lock:
+            batches = sum(self._batch_sizes.values())
+            return {"max_batch_size": self.max_batch_size,
+                    "max_wait_ms": self.max_wait * 1000,
+                    "queue_depth": self._queue.qsize(),
+                    "batches": batches,
+                    "items": self._items,
+                    "mean_batch_size": round(self._items / batches, 2) if batches else 0,
+                    "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                    "mean_queue_wait_ms": round(self._wait_total / self._items * 1000, 3) if self._items else 0,
+                    "max_queue_wait_ms": round(self._wait_max * 1000, 3)}
@@ -0,0 +1,329 @@
+"""Cache of inference results keyed by model, revision, parameters and input hash.
+An in memory LRU tier with time to live and an optional SQLite tier on disk
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def input_hash(data) -> str:
+    """Hashes the model input
+
+    Args:
+        data (str or bytes): Text or file contents
+
+    Returns:
+        str: Hex SHA-256 of the input
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """Two tier cache for JSON serializable results, the disk tier is only
+    used from one cache thread so the event loop never waits for SQLite
+    Methods: __init__
+            make_key
+            get
+            get_async
+            put
+            clear
+            stats
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_s: float = 3600, disk_path: str = ""):
+        """Constructor of the cache
+
+        Args:
+            max_entries (int, optional): Max results in memory. Defaults to 10000.
+            ttl_s (float, optional): Seconds a result stays valid, 0 never expires. Defaults to 3600.
+            disk_path (str, optional): SQLite file for the disk tier, "" disables it. Defaults to "".
+        """
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.disk_path = disk_path
+        self._disk_connection = None
+        self._disk_pid = None
+        self._disk_pool = None
+        self._pool_pid = None
+
+    def _disk_thread(self) -> ThreadPoolExecutor:
+        "The one thread using the disk tier, started again after a fork as threads are not copied"
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                self._disk_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+                self._pool_pid = os.getpid()
+            return self._disk_pool
+
+    @property
+    def _disk(self):
+        "SQLite connection of the disk tier, opened once per process as connections can not cross a fork"
+        if not self.disk_path:
+            return None
+        if self._disk_pid != os.getpid():
+            self._disk_connection = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._disk_connection.execute("PRAGMA journal_mode=WAL")
+            self._disk_connection.execute("PRAGMA synchronous=NORMAL")
+            self._disk_connection.execute("""CREATE TABLE IF NOT EXISTS results(
+                                             key TEXT PRIMARY KEY,
+                                             created REAL NOT NULL,
+                                             value TEXT NOT NULL)""")
+            self._disk_connection.commit()
+            self._disk_pid = os.getpid()
+        return self._disk_connection
+
+    @staticmethod
+    def make_key(model: str, revision: str, params: dict, data) -> str:
+        """Builds the cache key of one inference
+
+        Args:
+            model (str): Model name
+            revision (str): Model checkpoint and variant
+            params (dict): Parameters changing the result, e.g. labels
+            data (str or bytes): The model input
+
+        Returns:
+            str: Key for get and put
+        """
+        return input_hash(json.dumps([model, revision, params, input_hash(data)], sort_keys=True))
+
+    def _expired(self, created: float) -> bool:
+        "Returns True if a result created at this time is past its time to live"
+        return bool(self.ttl_s) and time.time() - created > self.ttl_s
+
+    def _get_memory(self, key: str):
+        "Looks up the memory tier, counts a hit"
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self._memory[key]
+        return None
+
+    def _get_disk(self, key: str):
+        "Looks up the disk tier in the cache thread, counts a hit or a miss"
+        row = None
+        if self._disk is not None:
+            row = self._disk.execute("SELECT created, value FROM results WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is not None and not self._expired(row[0]):
+                value = json.loads(row[1])
+                self._store_memory(key, row[0], value)
+                self._counters["disk_hits"] += 1
+                return value
+            self._counters["misses"] += 1
+        return None
+
+    def get(self, key: str):
+        """Looks up a result, first in memory then on disk, blocks while the disk is read
+
+        Args:
+            key (str): Key from make_key
+
+        Returns:
+            The cached result or None
+        """
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        return self._disk_thread().submit(self._get_disk, key).result()
+
+    async def get_async(self, key: str):
+        """Looks up a result like get, the event loop only reads the memory tier itself
+
+        Args:
+            key (str): Key from make_key
+
+        Returns:
+            The cached result or None
+        """
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        if not self.disk_path:
+            with self._lock:
+                self._counters["misses"] += 1
+            return None
+        return await asyncio.wrap_future(self._disk_thread().submit(self._get_disk, key))
+
+    def put(self, key: str, value):
+        """Stores a result in memory now and on disk in the cache thread
+
+        Args:
+            key (str): Key from make_key
+            value: JSON serializable result
+        """
+        created = time.time()
+        with self._lock:
+            self._store_memory(key, created, value)
+        if self.disk_path:
+            self._disk_thread().submit(self._put_disk, key, created, value)
+
+    def _put_disk(self, key: str, created: float, value):
+        "Writes a result to the disk tier in the cache thread"
+        try:
+            self._disk.execute("INSERT OR REPLACE INTO results (key, created, value) VALUES (?, ?, ?)",
+                               (key, created, json.dumps(value)))
+            self._disk.commit()
+        except sqlite3.Error as error:
+            print("Failed to write the result cache", error)
+
+    def _store_memory(self, key: str, created: float, value):
+        "Adds to the memory tier and evicts the least recently used results"
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        "Removes all results from both tiers"
+        with self._lock:
+            self._memory.clear()
+        if self.disk_path:
+            self._disk_thread().submit(self._clear_disk).result()
+
+    def _clear_disk(self):
+        "Empties the disk tier in the cache thread, after the writes queued before"
+        self._disk.execute("DELETE FROM results")
+        self._disk.commit()
+
+    def stats(self) -> dict:
+        """Reports hit and miss counters
+
+        Returns:
+            dict: Counters, hit rate and number of results in memory
+        """
+        with self._lock:
+            lookups = sum(self._counters.values())
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+            return dict(self._counters,
+                        hit_rate=round(hits / lookups, 3) if lookups else 0,
+                        memory_entries=len(self._memory),
+                        disk_enabled=bool(self.disk_path))
+
+
+def _past_bytes(past) -> int:
+    "Bytes of the key and value tensors of every layer"
+    return sum(tensor.numel() * tensor.element_size() for layer in past for tensor in layer)
+
+
+def _common_prefix(first: tuple, second: tuple) -> int:
+    "Number of leading tokens the two sequences share"
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+class PrefixCache:
+    """LRU cache of attention key and value tensors for prompt prefixes, so a
+    prompt sharing its start with an earlier prompt only runs its new tokens
+    Methods: __init__
+            lookup
+            put
+            clear
+            stats
+    """
+
+    def __init__(self, max_memory_mb: float = 128):
+        """Constructor of the cache
+
+        Args:
+            max_memory_mb (float, optional): Max memory of the cached tensors in
+                                             megabytes, 0 disables the cache. Defaults to 128.
+        """
+        self.max_memory = int(max_memory_mb * 1024 ** 2)
+        self._entries = OrderedDict()
+        self._memory = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "reused_tokens": 0, "computed_tokens": 0}
+
+    def lookup(self, tokens: list) -> tuple:
+        """Finds the cached prompt sharing the most leading tokens with tokens,
+        the last token is always left to compute so the model returns its logits
+
+        Args:
+            tokens (list): Token ids of the prompt
+
+        Returns:
+            tuple: Number of reused tokens and their past key values, (0, None) on a miss
+        """
+        tokens = tuple(tokens)
+        best_key, best_length = None, 0
+        with self._lock:
+            for key in self._entries:
+                length = min(_common_prefix(key, tokens), len(tokens) - 1)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None:
+                self._counters["misses"] += 1
+                self._counters["computed_tokens"] += len(tokens)
+                return 0, None
+            self._entries.move_to_end(best_key)
+            past, _ = self._entries[best_key]
+            self._counters["hits"] += 1
+            self._counters["reused_tokens"] += best_length
+            self._counters["computed_tokens"] += len(tokens) - best_length
+        # tensors are [batch, heads, tokens, head size], slicing keeps the shared prefix
+        return best_length, tuple(tuple(tensor[:, :, :best_length] for tensor in layer) for layer in past)
+
+    def put(self, tokens: list, past):
+        """Caches the past key values of a whole prompt, cached prompts that
+        are a prefix of it are dropped as the new entry covers them
+
+        Args:
+            tokens (list): Token ids of the prompt
+            past (tuple): Key and value tensors per layer for exactly these tokens
+        """
+        if not self.max_memory:
+            return
+        tokens = tuple(tokens)
+        size = _past_bytes(past)
+        if size > self.max_memory:
+            return
+        with self._lock:
+            if any(_common_prefix(key, tokens) == len(tokens) for key in self._entries):
+                return
+            for key in [key for key in self._entries if _common_prefix(key, tokens) == len(key)]:
+                self._memory -= self._entries.pop(key)[1]
+            self._entries[tokens] = (past, size)
+            self._memory += size
+            while self._memory > self.max_memory:
+                self._memory -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        "Removes all cached prefixes"
+        with self._lock:
+            self._entries.clear()
+            self._memory = 0
+
+    def stats(self) -> dict:
+        """Reports hit rate and memory
+
+        Returns:
+            dict: Counters, hit rate, share of prompt tokens reused, entries and memory
+        """
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            tokens = self._counters["reused_tokens"] + self._counters["computed_tokens"]
+            return dict(self._counters,
+                        hit_rate=round(self._counters["hits"] / lookups, 3) if lookups else 0,
+                        token_reuse_rate=round(self._counters["reused_tokens"] / tokens, 3) if tokens else 0,
+                        entries=len(self._entries),
+                        memory_mb=round(self._memory / 1024 ** 2, 1),
+                        max_memory_mb=round(self.max_memory / 1024 ** 2, 1))
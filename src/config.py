@@ -0,0 +1,105 @@
+"""Settings for the model server, read from environment variables
+so they can be set before starting ./src/main.py
+"""
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    "Returns an environment variable as an int or the default"
+    value = os.environ.get(name, "")
+    return int(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    "Returns an environment variable such as 1, true or yes as a bool or the default"
+    value = os.environ.get(name, "")
+    return value.strip().lower() in ("1", "true", "yes", "on") if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    "Returns an environment variable as a float or the default"
+    value = os.environ.get(name, "")
+    return float(value) if value else default
+
+
+MODEL_NAMES = ["question_answering", "text_generator", "sentiment_analysis", "image_classifier"]
+
+
+def _env_models(name: str, default: str = "") -> list:
+    "Returns a comma separated list of model names, all models for \"all\""
+    names = [model.strip() for model in os.environ.get(name, default).split(",") if model.strip()]
+    return list(MODEL_NAMES) if "all" in names else names
+
+
+# Directory with downloaded model weights, "" uses the transformers default cache
+MODEL_CACHE_DIR = os.environ.get("ML_MODEL_CACHE_DIR", "")
+
+# Load weights from the cache only, without network access, on by default with a cache directory
+OFFLINE = _env_bool("ML_OFFLINE", bool(MODEL_CACHE_DIR))
+
+# Memory budget for loaded models in megabytes, 0 means no limit
+MEMORY_BUDGET_MB = _env_float("ML_MEMORY_BUDGET_MB", 0)
+
+# Number of CLIP label text embeddings kept in memory
+LABEL_CACHE_SIZE = _env_int("ML_LABEL_CACHE_SIZE", 1024)
+
+# Micro batching per model as (max batch size, max wait in milliseconds), set with
+# e.g. ML_SENTIMENT_ANALYSIS_MAX_BATCH and ML_SENTIMENT_ANALYSIS_MAX_WAIT_MS
+BATCHING = {name: (_env_int(f"ML_{name.upper()}_MAX_BATCH", size),
+                   _env_float(f"ML_{name.upper()}_MAX_WAIT_MS", wait_ms))
+            for name, size, wait_ms in [("question_answering", 8, 5),
+                                        ("sentiment_analysis", 32, 5),
+                                        ("image_classifier", 16, 5)]}
+
+# Threads running inference, 0 sizes the pool from the torch thread setting
+# with at least one thread per model
+INFERENCE_WORKERS = _env_int("ML_INFERENCE_WORKERS", 0)
+
+# Threads loading models and generating text, kept apart from the inference
+# threads so these long calls never hold up the other models
+BACKGROUND_WORKERS = _env_int("ML_BACKGROUND_WORKERS", 4)
+
+# Intra-op threads used by torch, 0 keeps the torch default
+TORCH_THREADS = _env_int("ML_TORCH_THREADS", 0)
+
+# Question answering over one context and many questions: overlapping tokens
+# between context windows and number of tokenized contexts kept in memory
+QA_DOC_STRIDE = _env_int("ML_QA_DOC_STRIDE", 128)
+QA_CONTEXT_CACHE_SIZE = _env_int("ML_QA_CONTEXT_CACHE_SIZE", 64)
+
+# Memory for cached attention keys and values of text generation prompt prefixes
+# in megabytes, 0 disables the prefix cache
+TEXT_PREFIX_CACHE_MB = _env_float("ML_TEXT_PREFIX_CACHE_MB", 128)
+
+# Inference result cache: results in memory, seconds a result is valid (0 never
+# expires) and SQLite file for results that survive restarts ("" memory only)
+RESULT_CACHE_SIZE = _env_int("ML_RESULT_CACHE_SIZE", 10000)
+RESULT_CACHE_TTL_S = _env_float("ML_RESULT_CACHE_TTL_S", 3600)
+RESULT_CACHE_PATH = os.environ.get("ML_RESULT_CACHE_PATH", "")
+
+# Largest accepted image file and request body in megabytes
+MAX_UPLOAD_BYTES = int(_env_float("ML_MAX_UPLOAD_MB", 10) * 1024 ** 2)
+MAX_REQUEST_BYTES = int(_env_float("ML_MAX_REQUEST_MB", 100) * 1024 ** 2)
+
+# Smallest image side needed by CLIP, JPEG files are decoded at reduced scale down to it
+IMAGE_DECODE_SIZE = _env_int("ML_IMAGE_DECODE_SIZE", 224)
+
+# Largest accepted image in pixels, checked before the image is decoded
+MAX_IMAGE_PIXELS = _env_int("ML_MAX_IMAGE_PIXELS", 64_000_000)
+
+# Models running with int8 dynamic quantized linear layers, comma separated
+# model names or "all", e.g. ML_QUANTIZE=question_answering,sentiment_analysis
+QUANTIZE = _env_models("ML_QUANTIZE")
+
+# Address the server listens on
+HOST = os.environ.get("ML_HOST", "127.0.0.1")
+PORT = _env_int("ML_PORT", 8000)
+
+# Worker processes, above 1 the models in ML_PRELOAD (default all) are loaded
+# before fork and shared copy-on-write by the workers
+WORKERS = _env_int("ML_WORKERS", 1)
+PRELOAD = _env_models("ML_PRELOAD", "all" if WORKERS > 1 else "")
+
+# Models loaded in a background thread once the server is up, "/ready" answers
+# 503 until these and the preloaded models are loaded
+WARMUP = _env_models("ML_WARMUP")
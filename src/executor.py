@@ -0,0 +1,92 @@
+"""Thread pool that runs blocking model inference outside the asyncio event loop
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+def default_workers(torch_threads: int = 0, min_workers: int = 1) -> int:
+    """Number of inference threads that fit the torch intra-op thread setting,
+    so the threads together do not use more cores than the machine has, but at
+    least min_workers. Torch uses about every core by default, so without a
+    setting this is min_workers.
+
+    Args:
+        torch_threads (int, optional): Intra-op threads, 0 is the torch default. Defaults to 0.
+        min_workers (int, optional): Fewest threads, e.g. one per model. Defaults to 1.
+
+    Returns:
+        int: Number of worker threads
+    """
+    cpu_count = os.cpu_count() or 1
+    return max(1, min_workers, cpu_count // (torch_threads or cpu_count))
+
+
+class InferenceExecutor:
+    """Runs blocking calls in a dedicated thread pool
+    Methods: __init__
+            submit
+            run
+            shutdown
+    """
+
+    def __init__(self, max_workers: int = 0, torch_threads: int = 0, min_workers: int = 1):
+        """Constructor of the executor
+
+        Args:
+            max_workers (int, optional): Threads in the pool, 0 sizes it from the
+                                         torch thread setting. Defaults to 0.
+            torch_threads (int, optional): Intra-op threads for torch, 0 keeps the
+                                           torch default. Defaults to 0.
+            min_workers (int, optional): Fewest threads when the size comes from the
+                                         torch thread setting. Defaults to 1.
+        """
+        self.max_workers = max_workers
+        self.torch_threads = torch_threads
+        self.min_workers = min_workers
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        "Creates the pool on first use, again after a fork as threads are not copied"
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # sized when first used so worker processes can set the pool size first,
+                # torch is only imported in the pool threads so the event loop never waits for it
+                max_workers = self.max_workers or default_workers(self.torch_threads, self.min_workers)
+                self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix="inference",
+                                                initializer=self._init_thread)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _init_thread(self):
+        "Sets the torch intra-op threads, runs in each pool thread when it starts"
+        if self.torch_threads:
+            import torch
+            torch.set_num_threads(self.torch_threads)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Runs fn in the pool
+
+        Returns:
+            Future: Resolves to the return value of fn
+        """
+        return self._get_pool().submit(fn, *args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs fn in the pool and waits for it without blocking the event loop
+
+        Returns:
+            The return value of fn
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self):
+        "Waits for running calls and stops the pool"
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=True)
+            self._pool = None
@@ -1,15 +1,34 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
-import models
+import asyncio
+import json
+import threading
+import time
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
+from functools import partial
+from typing import Dict, List, Optional, Union
 from enum import Enum
 from PIL import Image
 from io import BytesIO
-import numpy as np
 from pathlib import Path
 import uvicorn
-from starlette.responses import RedirectResponse
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Match
 from pydantic import BaseModel
 
-from utils import read_imagefile
+from utils import decode_embedding, encode_embedding, read_imagefile, read_upload
+from registry import ModelRegistry
+from batching import MicroBatcher
+from executor import InferenceExecutor
+from cache import PrefixCache, ResultCache
+from workers import WorkerPool
+from metrics import MetricsRegistry, process_resident_memory
+import config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = "application/msgpack"
 
 class ModelName(str, Enum):
     question_answering = "question_answering"
@@ -24,102 +43,590 @@ class QuestionAnswering(BaseModel):
     context: str
     question: str
 
+class QuestionAnsweringBatch(BaseModel):
+    items: List[QuestionAnswering]
+
+class QuestionAnsweringMulti(BaseModel):
+    context: str
+    questions: List[str]
+    doc_stride: Optional[int] = None
+
 class TextContext(BaseModel):
     context: str
 
-class Image_Classes(BaseModel):
-    class_1: str
-    class_2: str
-    class_3: str
+class TextBatch(BaseModel):
+    texts: List[str]
+
+class ImageLabels(BaseModel):
+    labels: List[str]
+
+class ImageEmbedding(BaseModel):
+    embedding: str
+    labels: List[str] = []
+
+class Answer(BaseModel):
+    answer: str
+    score: float
+
+class Sentiment(BaseModel):
+    sentiment_label: str
+    score: float
+
+class GeneratedText(BaseModel):
+    generated_text: str
+
+class ImageClassification(BaseModel):
+    probabilities: Dict[str, float]
+    embedding: Optional[str] = None
+
+class TextEmbedding(BaseModel):
+    embedding: str
+
+class ItemError(BaseModel):
+    detail: str
+    status_code: int
+
+TEXT_GENERATION_PARAMS = {"min_length": 50, "max_length": 500}
 
 app = FastAPI()
-global model
-global chosen_model_name
+# one inference thread per model by default so a busy model never blocks the others
+executor = InferenceExecutor(config.INFERENCE_WORKERS, config.TORCH_THREADS, min_workers=len(ModelName))
+background_executor = InferenceExecutor(config.BACKGROUND_WORKERS, config.TORCH_THREADS)
+
+metrics = MetricsRegistry()
+request_count = metrics.counter("ml_http_requests_total", "HTTP requests by endpoint, method and status",
+                                ("endpoint", "method", "status"))
+request_latency = metrics.histogram("ml_http_request_duration_seconds",
+                                    "Seconds until the response starts", ("endpoint", "method"))
+requests_in_flight = metrics.gauge("ml_http_requests_in_flight", "Requests being handled", ("endpoint",))
+model_loaded = metrics.gauge("ml_model_loaded", "1 if the model is loaded", ("model",))
+model_memory = metrics.gauge("ml_model_memory_bytes", "Memory of the model weights", ("model",))
+model_load_time = metrics.gauge("ml_model_load_seconds", "Seconds the last load of the model took", ("model",))
+inference_time = metrics.histogram("ml_model_inference_seconds", "Seconds of one batched model call", ("model",))
+queue_depth = metrics.gauge("ml_batch_queue_depth", "Requests waiting for a micro batch", ("model",))
+generated_tokens = metrics.counter("ml_generated_tokens_total", "Tokens generated by text generation", ("mode",))
+tokens_per_second = metrics.histogram("ml_generation_tokens_per_second", "Tokens per second of one generation",
+                                      ("mode",), buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+image_decode_time = metrics.histogram("ml_image_decode_seconds", "Seconds to decode one uploaded image",
+                                      buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+prefix_cache_hit_rate = metrics.gauge("ml_prefix_cache_hit_rate",
+                                     "Share of text generation prompts that reused a cached prefix")
+prefix_cache_memory = metrics.gauge("ml_prefix_cache_memory_bytes", "Memory of cached prompt prefixes")
+process_memory = metrics.gauge("ml_process_resident_memory_bytes", "Resident memory of the server process")
+
+
+def _quantized(name: ModelName) -> bool:
+    "Returns True if the model runs int8 quantized"
+    return name.value in config.QUANTIZE
+
+MODEL_CLASSES = {ModelName.question_answering: "QA",
+                 ModelName.text_generation: "TextGenerator",
+                 ModelName.sentiment_analysis: "SentimentAnalyser",
+                 ModelName.image_classifier: "ImageClassifier"}
+
+
+def _model_class(name: ModelName):
+    "Imports models.py on first use, so torch and transformers are not loaded before the server is up"
+    import models
+    return getattr(models, MODEL_CLASSES[name])
+
+
+# kept outside the model so cached prefixes and statistics survive unloading it
+prefix_cache = PrefixCache(config.TEXT_PREFIX_CACHE_MB)
+
+
+def _create_model(name: ModelName, **kwargs):
+    "Creates the model, int8 quantized if configured"
+    return _model_class(name)(quantized=_quantized(name), **kwargs)
+
+registry = ModelRegistry({ModelName.question_answering: partial(_create_model, ModelName.question_answering,
+                                                                doc_stride=config.QA_DOC_STRIDE,
+                                                                context_cache_size=config.QA_CONTEXT_CACHE_SIZE),
+                          ModelName.text_generation: partial(_create_model, ModelName.text_generation,
+                                                             prefix_cache=prefix_cache),
+                          ModelName.sentiment_analysis: partial(_create_model, ModelName.sentiment_analysis),
+                          ModelName.image_classifier: partial(_create_model, ModelName.image_classifier,
+                                                              label_cache_size=config.LABEL_CACHE_SIZE)},
+                         memory_budget_mb=config.MEMORY_BUDGET_MB)
+
+
+def _answer_batch(items: list) -> list:
+    "Answers a batch of (question, context) pairs"
+    questions, contexts = zip(*items)
+    with registry.use(ModelName.question_answering) as model, \
+            inference_time.time(model=ModelName.question_answering.value):
+        return model.answer_questions(list(questions), list(contexts))
+
+
+def _answer_about(context: str, questions: list, doc_stride: int) -> list:
+    "Answers many questions about one context"
+    with registry.use(ModelName.question_answering) as model, \
+            inference_time.time(model=ModelName.question_answering.value):
+        return model.answer_questions_about(context, questions, doc_stride)
+
+
+def _sentiment_batch(texts: list) -> list:
+    "Analyses the sentiment of a batch of texts"
+    with registry.use(ModelName.sentiment_analysis) as model, \
+            inference_time.time(model=ModelName.sentiment_analysis.value):
+        return model.analyse_texts(texts)
+
+
+def _record_generation(model, text: str, seconds: float, mode: str):
+    "Records the number of generated tokens and the tokens per second"
+    tokens = model.count_tokens(text)
+    generated_tokens.inc(tokens, mode=mode)
+    if seconds > 0:
+        tokens_per_second.observe(tokens / seconds, mode=mode)
+
+
+def _generate_text(context: str) -> dict:
+    "Generates a continuation of the context"
+    with registry.use(ModelName.text_generation) as model:
+        with inference_time.time(model=ModelName.text_generation.value):
+            start = time.perf_counter()
+            response = model.generate_text(context, **TEXT_GENERATION_PARAMS)[0]
+        _record_generation(model, response["generated_text"][len(context):],
+                           time.perf_counter() - start, "full")
+        return response
+
+
+def _classify_batch(items: list) -> list:
+    "Classifies a batch of (image, labels) pairs, returns (probabilities, embedding) pairs"
+    images, labels_list = zip(*items)
+    with registry.use(ModelName.image_classifier) as model, \
+            inference_time.time(model=ModelName.image_classifier.value):
+        results, embeddings = model.classify_batch(list(images), list(labels_list), return_embeddings=True)
+    return list(zip(results, embeddings))
+
+
+def _score_embedding(embedding, labels: list) -> dict:
+    "Classifies a stored image embedding"
+    with registry.use(ModelName.image_classifier) as model:
+        return model.score_embedding(embedding, labels)
+
+
+def _text_embedding(text: str):
+    "Embeds a text for searching stored image embeddings"
+    with registry.use(ModelName.image_classifier) as model:
+        return model.text_embedding(text)
+
+
+def _decode_image(file_contents: bytes) -> Image.Image:
+    "Decodes an uploaded image and records the decode time"
+    with image_decode_time.time():
+        return read_imagefile(file_contents, config.IMAGE_DECODE_SIZE, config.MAX_IMAGE_PIXELS)
+
+
+revisions = {}
+
+
+async def _revision(name: ModelName) -> str:
+    "Checkpoint and variant of the model, part of every cache key"
+    if name not in revisions:
+        # the first import of models.py is slow, it runs outside the event loop
+        model_class = await background_executor.run(_model_class, name)
+        revisions[name] = model_class.checkpoint + ("+int8" if _quantized(name) else "")
+    return revisions[name]
+
+result_cache = ResultCache(config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL_S, config.RESULT_CACHE_PATH)
+# default classes for image requests without labels, changed by /change_classes/
+image_labels = ['cat', 'dog', 'banana']
+
+batchers = {name: MicroBatcher(batch_fn, *config.BATCHING[name.value], executor=executor)
+            for name, batch_fn in [(ModelName.question_answering, _answer_batch),
+                                   (ModelName.sentiment_analysis, _sentiment_batch),
+                                   (ModelName.image_classifier, _classify_batch)]}
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    "Refuses requests that announce a body above the limit before it is read"
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > config.MAX_REQUEST_BYTES:
+        return JSONResponse(status_code=413, content={"detail": "Request body is too large."})
+    return await call_next(request)
+
+
+def _route_path(request: Request) -> str:
+    "Route template of the request, so path parameters do not add label values"
+    for route in app.router.routes:
+        if route.matches(request.scope)[0] == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    "Counts requests and records their latency per endpoint"
+    endpoint = _route_path(request)
+    requests_in_flight.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        request_latency.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+        request_count.inc(endpoint=endpoint, method=request.method, status=status)
+        requests_in_flight.dec(endpoint=endpoint)
+
+
+@metrics.on_collect
+def _collect_model_metrics():
+    "Reads model, batching and process state when /metrics is scraped"
+    for name, status in registry.status()["models"].items():
+        model_loaded.set(int(status["loaded"]), model=name)
+        model_memory.set(round(status.get("memory_mb", 0) * 1024 ** 2), model=name)
+        model_load_time.set(status.get("load_time_s", 0), model=name)
+    for name, batcher in batchers.items():
+        queue_depth.set(batcher.stats()["queue_depth"], model=name.value)
+    prefix_stats = prefix_cache.stats()
+    prefix_cache_hit_rate.set(prefix_stats["hit_rate"])
+    prefix_cache_memory.set(round(prefix_stats["memory_mb"] * 1024 ** 2))
+    process_memory.set(process_resident_memory())
 
 @app.get("/", include_in_schema=False)
 async def index():
     return RedirectResponse(url="/docs")
 
 @app.post("/start/", status_code=200)
-def start_model(chosen_model: ModelChoice):
-    global model
-    global chosen_model_name
-    if chosen_model.name == ModelName.question_answering:
-        model = models.QA()
-        chosen_model_name = chosen_model.name
-    elif chosen_model.name == ModelName.text_generation:
-        model = models.TextGenerator()
-        chosen_model_name = chosen_model.name
-    elif chosen_model.name == ModelName.sentiment_analysis:
-        model = models.SentimentAnalyser()
-        chosen_model_name = chosen_model.name
-    elif chosen_model.name == ModelName.image_classifier:
-        model = models.ImageClassifier()
-        chosen_model_name = chosen_model.name
-    else:
-        raise HTTPException(status_code=500, detail="Model name not correct, please revise.")
+async def start_model(chosen_model: ModelChoice):
+    await background_executor.run(registry.load, chosen_model.name)
+    return registry.status()["models"][chosen_model.name.value]
 
 
-@app.post("/qa/")
-def qa_pipeline(question_answering: QuestionAnswering):
-    if chosen_model_name == ModelName.question_answering:
-        try:
-            response = model.answer_question(question_answering.question, question_answering.context)
-            answer = response['answer']
-            score = response['score']
-            return {'answer':answer, 'score':score}
-        except NameError:
-            raise HTTPException(status_code=500, detail="Model not working - did you forget to start the model?")
-    else:
-        raise HTTPException(status_code=500, detail="Remember to start the correct model before calling this method.")
+@app.get("/models/")
+async def loaded_models():
+    status = registry.status()
+    for name, model_status in status["models"].items():
+        model_status["revision"] = await _revision(ModelName(name))
+    return status
 
 
-@app.post("/text_generation/")
-def text_generation(text_gen: TextContext):
-    if chosen_model_name == ModelName.text_generation:
-        try:
-            response = model.generate_text(text_gen.context)[0]
-            generated_text = response["generated_text"]
-            return {'generated_text': generated_text}
-        except NameError:
-            raise HTTPException(status_code=500, detail="Model not working - did you forget to start the model?")
-    else:
-        raise HTTPException(status_code=500, detail="Remember to start the correct model before calling this method.")
+@app.get("/health")
+async def health():
+    "Liveness, answers as soon as the server is up"
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    "Readiness, 503 until the preloaded and warm-up models are loaded"
+    status = registry.status()["models"]
+    expected = dict.fromkeys(config.PRELOAD + config.WARMUP)
+    is_ready = all(status.get(name, {}).get("loaded") for name in expected) and not warmup_errors
+    models = {name: {"loaded": model_status["loaded"], "loading": model_status.get("loading", False)}
+              for name, model_status in status.items()}
+    return JSONResponse(status_code=200 if is_ready else 503,
+                        content={"ready": is_ready, "models": models, "errors": warmup_errors})
+
 
-@app.post("/sentiment_analysis/")
-def sentiment_analysis(text: TextContext):
-    if chosen_model_name == ModelName.sentiment_analysis:
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/batching/")
+async def batching_stats():
+    return {name.value: batcher.stats() for name, batcher in batchers.items()}
+
+
+@app.delete("/models/{name}")
+async def unload_model(name: ModelName):
+    if not await background_executor.run(registry.unload, name):
+        raise HTTPException(status_code=409, detail="Model is not loaded or is in use.")
+    return registry.status()
+
+
+def _respond(request: Request, content) -> Response:
+    """Encodes a response as MessagePack when the client accepts it and msgpack
+    is installed, otherwise as JSON. The content is already made of plain types
+    so the response model is only used for the documentation"""
+    if msgpack is not None and MSGPACK in request.headers.get("accept", ""):
+        return Response(msgpack.packb(content, use_bin_type=True), media_type=MSGPACK)
+    return JSONResponse(content)
+
+
+async def _cached(name: ModelName, params: dict, data, compute) -> dict:
+    "Returns the cached response or awaits compute() and caches its response"
+    key = result_cache.make_key(name.value, await _revision(name), params, data)
+    response = await result_cache.get_async(key)
+    if response is None:
+        response = await compute()
+        result_cache.put(key, response)
+    return response
+
+
+async def _answer(question: str, context: str) -> dict:
+    "Answers one question, cached"
+    async def compute():
+        response = await asyncio.wrap_future(
+            batchers[ModelName.question_answering].submit((question, context)))
+        return {'answer': response['answer'], 'score': float(response['score'])}
+    return await _cached(ModelName.question_answering, {}, json.dumps([question, context]), compute)
+
+
+async def _analyse(text: str) -> dict:
+    "Analyses the sentiment of one text, cached"
+    async def compute():
+        response = await asyncio.wrap_future(batchers[ModelName.sentiment_analysis].submit(text))
+        return {'sentiment_label': response["label"], 'score': float(response["score"])}
+    return await _cached(ModelName.sentiment_analysis, {}, text, compute)
+
+
+async def _classify(file_contents: bytes, labels: list, embedding: bool = False) -> dict:
+    """Decodes and classifies one image, cached so a hit skips the decode,
+    with embedding the float16 image embedding is returned next to the probabilities"""
+    labels = labels or list(image_labels)
+    async def compute():
         try:
-            response = model.analyse_text(text.context)[0]
-            label = response["label"]
-            score = response["score"]
-            return {'sentiment_label': label, 'score': score}
-        except NameError:
-            raise HTTPException(status_code=500, detail="Model not working - did you forget to start the model?")
-    else:
-        raise HTTPException(status_code=500, detail="Remember to start the correct model before calling this method.")
+            image = await executor.run(_decode_image, file_contents)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            raise HTTPException(status_code=400,
+                                detail=f"File is not a readable image of at most {config.MAX_IMAGE_PIXELS} pixels.")
+        probabilities, image_embedding = await asyncio.wrap_future(
+            batchers[ModelName.image_classifier].submit((image, labels)))
+        return {"probabilities": {key: float(value) for key, value in probabilities.items()},
+                "embedding": encode_embedding(image_embedding)}
+    response = await _cached(ModelName.image_classifier,
+                             {"labels": labels, "embedding": "float16", "scores": "float"},
+                             file_contents,
+                             compute)
+    return response if embedding else response["probabilities"]
+
 
+@app.post("/qa/", response_model=Answer)
+async def qa_pipeline(question_answering: QuestionAnswering, request: Request):
+    return _respond(request, await _answer(question_answering.question, question_answering.context))
 
-@app.post("/classify_image/")
-async def classify_image(file: UploadFile = File(...)):
-    if chosen_model_name == ModelName.image_classifier:
+
+@app.post("/qa/batch", response_model=List[Answer])
+async def qa_batch(batch: QuestionAnsweringBatch, request: Request):
+    return _respond(request, await asyncio.gather(*[_answer(item.question, item.context)
+                                                    for item in batch.items]))
+
+
+@app.post("/qa/multi", response_model=List[Answer])
+async def qa_multi(multi: QuestionAnsweringMulti, request: Request):
+    doc_stride = config.QA_DOC_STRIDE if multi.doc_stride is None else multi.doc_stride
+    params = {"doc_stride": doc_stride}
+    questions = list(dict.fromkeys(multi.questions))
+    revision = await _revision(ModelName.question_answering)
+    keys = {question: result_cache.make_key(ModelName.question_answering.value, revision, params,
+                                            json.dumps([question, multi.context]))
+            for question in questions}
+    answers = dict(zip(keys, await asyncio.gather(*[result_cache.get_async(key) for key in keys.values()])))
+    missing = [question for question, answer in answers.items() if answer is None]
+    if missing:
         try:
-            file_contents = await file.read()
-            image = read_imagefile(file_contents)
-            response = model.classify(image)
-            return {key: str(value) for key, value in response.items()}
-        except NameError:
-            raise HTTPException(status_code=500, detail="Model not working - did you forget to start the model?")
-    else:
-        raise HTTPException(status_code=500, detail="Remember to start the correct model before calling this method.")
-    
+            responses = await executor.run(_answer_about, multi.context, missing, doc_stride)
+        except ValueError as error:
+            raise HTTPException(status_code=422, detail=str(error))
+        for question, response in zip(missing, responses):
+            answers[question] = {'answer': response['answer'], 'score': float(response['score'])}
+            result_cache.put(keys[question], answers[question])
+    return _respond(request, [answers[question] for question in multi.questions])
+
+
+@app.post("/text_generation/", response_model=GeneratedText)
+async def text_generation(text_gen: TextContext, request: Request):
+    async def compute():
+        response = await background_executor.run(_generate_text, text_gen.context)
+        return {'generated_text': response["generated_text"]}
+    return _respond(request, await _cached(ModelName.text_generation,
+                                           TEXT_GENERATION_PARAMS,
+                                           text_gen.context,
+                                           compute))
+
+
+def _server_sent_event(data: dict, event: str = "") -> str:
+    "Formats one server-sent event"
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+
+
+async def _stream_tokens(context: str):
+    "Runs generation in the background executor and yields each new token as an event"
+    key = result_cache.make_key(ModelName.text_generation.value,
+                                await _revision(ModelName.text_generation),
+                                TEXT_GENERATION_PARAMS,
+                                context)
+    cached = await result_cache.get_async(key)
+    if cached is not None:
+        yield _server_sent_event({'token': cached["generated_text"][len(context):]})
+        yield _server_sent_event(cached, "done")
+        return
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        with registry.use(ModelName.text_generation) as model:
+            start = time.perf_counter()
+            produced = []
+            for token in model.stream_text(context, **TEXT_GENERATION_PARAMS):
+                if stop.is_set():
+                    break
+                produced.append(token)
+                loop.call_soon_threadsafe(tokens.put_nowait, token)
+            _record_generation(model, "".join(produced), time.perf_counter() - start, "stream")
+
+    producing = background_executor.submit(produce)
+    producing.add_done_callback(lambda _: loop.call_soon_threadsafe(tokens.put_nowait, None))
+    pieces = []
+    try:
+        while True:
+            token = await tokens.get()
+            if token is None:
+                break
+            pieces.append(token)
+            yield _server_sent_event({'token': token})
+        if producing.exception() is not None:
+            yield _server_sent_event({'detail': str(producing.exception())}, "error")
+            return
+        response = {'generated_text': context + "".join(pieces)}
+        result_cache.put(key, response)
+        yield _server_sent_event(response, "done")
+    finally:
+        # stops generation when the client disconnects
+        stop.set()
+
+
+@app.post("/text_generation/stream")
+async def text_generation_stream(text_gen: TextContext):
+    return StreamingResponse(_stream_tokens(text_gen.context), media_type="text/event-stream")
+
+@app.post("/sentiment_analysis/", response_model=Sentiment)
+async def sentiment_analysis(text: TextContext, request: Request):
+    return _respond(request, await _analyse(text.context))
+
+
+@app.post("/sentiment_analysis/batch", response_model=List[Sentiment])
+async def sentiment_analysis_batch(batch: TextBatch, request: Request):
+    return _respond(request, await asyncio.gather(*[_analyse(text) for text in batch.texts]))
+
+
+def _clean_labels(labels: Optional[List[str]]) -> list:
+    "Removes empty and duplicated labels, keeps the order"
+    return list(dict.fromkeys(label.strip() for label in labels or [] if label.strip()))
+
+
+@app.post("/classify_image/", response_model=Union[ImageClassification, Dict[str, float]])
+async def classify_image(request: Request, file: UploadFile = File(...),
+                         labels: Optional[List[str]] = Form(None), embedding: bool = False):
+    file_contents = await read_upload(file, config.MAX_UPLOAD_BYTES)
+    return _respond(request, await _classify(file_contents, _clean_labels(labels), embedding))
+
+
+async def _classify_item(file_contents, labels: list, embedding: bool) -> dict:
+    "Classifies one image of a batch, a file that fails gets an error entry instead of failing the batch"
+    try:
+        if isinstance(file_contents, HTTPException):
+            raise file_contents
+        return await _classify(file_contents, labels, embedding)
+    except HTTPException as error:
+        return {"detail": error.detail, "status_code": error.status_code}
+    except Exception as error:
+        print("Failed to classify an image of a batch", repr(error))
+        return {"detail": "The image could not be classified.", "status_code": 500}
+
+
+@app.post("/classify_image/batch",
+          response_model=List[Union[ImageClassification, Dict[str, float], ItemError]])
+async def classify_image_batch(request: Request,
+                               files: List[UploadFile] = File(...),
+                               labels: Optional[List[str]] = Form(None),
+                               embedding: bool = False):
+    labels = _clean_labels(labels)
+    chunk_size = batchers[ModelName.image_classifier].max_batch_size
+    responses = []
+    # decoded images are only kept for one chunk at a time
+    for start in range(0, len(files), chunk_size):
+        contents = []
+        for file in files[start:start + chunk_size]:
+            try:
+                contents.append(await read_upload(file, config.MAX_UPLOAD_BYTES))
+            except HTTPException as error:
+                contents.append(error)
+        responses += await asyncio.gather(*[_classify_item(file_contents, labels, embedding)
+                                            for file_contents in contents])
+    return _respond(request, responses)
+
+
+@app.post("/classify_embedding/", response_model=Dict[str, float])
+async def classify_embedding(image: ImageEmbedding, request: Request):
+    labels = _clean_labels(image.labels) or list(image_labels)
+    try:
+        response = await executor.run(_score_embedding, decode_embedding(image.embedding), labels)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    return _respond(request, {key: float(value) for key, value in response.items()})
+
+
+@app.post("/text_embedding/", response_model=TextEmbedding)
+async def text_embedding(text: TextContext, request: Request):
+    if not text.context.strip():
+        raise HTTPException(status_code=422, detail="Provide a text to embed.")
+    embedding = await executor.run(_text_embedding, text.context.strip())
+    return _respond(request, {"embedding": encode_embedding(embedding)})
+
+
 @app.put("/change_classes/")
-def change_model_classes(new_classes: Image_Classes):
-    global model
-    global chosen_model_name
-    if chosen_model_name == ModelName.image_classifier:
-        model = models.ImageClassifier(
-            labels = [new_classes.class_1, new_classes.class_2, new_classes.class_3])
+async def change_model_classes(new_classes: ImageLabels):
+    labels = _clean_labels(new_classes.labels)
+    if not labels:
+        raise HTTPException(status_code=422, detail="Provide at least one class label.")
+    image_labels[:] = labels
+
+
+@app.get("/text_generation/prefix_cache")
+async def prefix_cache_stats():
+    return prefix_cache.stats()
+
+
+@app.delete("/text_generation/prefix_cache")
+async def clear_prefix_cache():
+    prefix_cache.clear()
+    return prefix_cache.stats()
+
+
+@app.get("/cache/")
+async def cache_stats():
+    return result_cache.stats()
+
+
+@app.delete("/cache/")
+async def clear_cache():
+    await executor.run(result_cache.clear)
+    return result_cache.stats()
+
+warmup_errors = {}
+
+
+def _warm_up(names: list):
+    "Loads the models one at a time and keeps the errors for /ready"
+    for name in names:
+        try:
+            registry.load(name)
+        except Exception as error:
+            warmup_errors[name] = str(error)
+
+
+@app.on_event("startup")
+def start_warm_up():
+    if config.WARMUP:
+        threading.Thread(target=_warm_up, args=(config.WARMUP,), name="warm-up", daemon=True).start()
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    executor.shutdown()
+    background_executor.shutdown()
 
 if __name__ == "__main__":
-    uvicorn.run(app, debug=True)
\ No newline at end of file
+    if config.WORKERS > 1:
+        WorkerPool(app, registry, executor, config.PRELOAD, config.WORKERS,
+                   config.HOST, config.PORT, config.TORCH_THREADS).serve()
+    else:
+        for name in config.PRELOAD:
+            registry.load(name)
+        uvicorn.run(app, host=config.HOST, port=config.PORT, debug=True)
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""Counters, gauges and histograms rendered in the Prometheus text format
+Each worker process keeps its own values
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    "Formats a sample value, whole numbers without decimals"
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    "Formats label pairs as {name=\"value\",...}"
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def process_resident_memory() -> int:
+    """Resident memory of this process, the peak on systems without /proc
+    and 0 on Windows
+
+    Returns:
+        int: Memory in bytes
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        # Unix only, imported here so the server still starts on Windows
+        import resource
+    except ImportError:
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Metric:
+    "One metric family with a value per combination of label values"
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        "Label values in the order of labelnames"
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> list:
+        "Returns (suffix, label names, label values, value) for every sample"
+        with self._lock:
+            return [("", self.labelnames, key, value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        """Renders the family in the Prometheus text format
+
+        Returns:
+            list: Lines of the HELP, TYPE and sample lines
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Value that only goes up
+    Methods: inc
+    """
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down
+    Methods: set
+            inc
+            dec
+    """
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Counts observations in cumulative buckets
+    Methods: __init__
+            observe
+            time
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        """Constructor of the histogram
+
+        Args:
+            name (str): Metric name
+            documentation (str): HELP text
+            labelnames (tuple, optional): Names of the labels. Defaults to ().
+            buckets (tuple, optional): Sorted upper bounds of the buckets. Defaults to DEFAULT_BUCKETS.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # one count per bucket and a last one for values above every bucket
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        "Observes the seconds the block takes"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list:
+        names = self.labelnames + ("le",)
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append(("_bucket", names, key + (_format_value(bound),), cumulative))
+                samples.append(("_sum", self.labelnames, key, total))
+                samples.append(("_count", self.labelnames, key, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Holds the metric families of the server and renders them together
+    Methods: __init__
+            counter
+            gauge
+            histogram
+            on_collect
+            render
+    """
+
+    def __init__(self):
+        "Constructor of the registry"
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def on_collect(self, collector):
+        """Registers a function that updates gauges right before rendering,
+        for values that are read from other objects instead of recorded
+
+        Args:
+            collector (callable): Function without arguments
+        """
+        self._collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        """Renders all families in the Prometheus text format
+
+        Returns:
+            str: The exposition text
+        """
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
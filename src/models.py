@@ -1,13 +1,58 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import config
+
+# transformers reads these once when it is imported
+if config.MODEL_CACHE_DIR:
+    os.environ["TRANSFORMERS_CACHE"] = config.MODEL_CACHE_DIR
+if config.OFFLINE:
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+import torch
 from transformers import pipeline
 from transformers import CLIPProcessor, CLIPModel
 import PIL
 
+def quantize_linear_layers(model):
+    """Replaces the linear layers of a torch model with int8 dynamic quantized
+    layers, weights are stored as int8 and activations are quantized per batch
+
+    Args:
+        model (torch.nn.Module): The fp32 model
+
+    Returns:
+        torch.nn.Module: The quantized model
+    """
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
 class QA:
+    checkpoint = "bert-large-uncased-whole-word-masking-finetuned-squad"
 
-    def __init__(self):
+    def __init__(self, max_seq_len=384, doc_stride=128, max_answer_len=15, max_question_len=64,
+                 context_cache_size=64, quantized=False):
         """Constructor of QA class, defining the transformers pipeline
+
+        Args:
+            max_seq_len (int, optional): Max tokens in one window of question and context. Defaults to 384.
+            doc_stride (int, optional): Overlapping tokens between context windows. Defaults to 128.
+            max_answer_len (int, optional): Max tokens in an answer. Defaults to 15.
+            max_question_len (int, optional): Max question tokens when many questions share a context,
+                                              the context windows are sized for it. Defaults to 64.
+            context_cache_size (int, optional): Max number of tokenized contexts kept in memory. Defaults to 64.
+            quantized (bool, optional): Use int8 dynamic quantized linear layers. Defaults to False.
         """
-        self.pipeline = pipeline("question-answering", model="bert-large-uncased-whole-word-masking-finetuned-squad")
+        self.pipeline = pipeline("question-answering", model=self.checkpoint)
+        if quantized:
+            self.pipeline.model = quantize_linear_layers(self.pipeline.model)
+        self.max_seq_len = max_seq_len
+        self.doc_stride = doc_stride
+        self.max_answer_len = max_answer_len
+        self.max_question_len = max_question_len
+        self.context_cache_size = context_cache_size
+        self._context_cache = OrderedDict()
+        self._context_lock = threading.Lock()
 
     def answer_question(self, question: str, context: str) -> dict:
         """Runs the input through the pre-defined QA pipeline
@@ -21,16 +66,158 @@ class QA:
         """
         return self.pipeline(question=question, context=context)
 
+    def answer_questions(self, questions: list, contexts: list) -> list:
+        """Answers several question and context pairs in one batched forward pass
+
+        Args:
+            questions (list): The questions to be answered
+            contexts (list): The context for each question
+
+        Returns:
+            list(dict): Answer, score, start and end for each question
+        """
+        encodings = self.pipeline.tokenizer(questions, contexts,
+                                            truncation="only_second",
+                                            max_length=self.max_seq_len,
+                                            stride=self.doc_stride,
+                                            return_overflowing_tokens=True,
+                                            return_offsets_mapping=True,
+                                            padding=True,
+                                            return_tensors="pt")
+        sample_mapping = encodings.pop("overflow_to_sample_mapping").tolist()
+        offsets = encodings.pop("offset_mapping").tolist()
+        with torch.no_grad():
+            outputs = self.pipeline.model(**encodings)
+        best = [(0.0, 0, 0)] * len(questions)
+        for window, sample in enumerate(sample_mapping):
+            span = self._best_span(outputs.start_logits[window],
+                                   outputs.end_logits[window],
+                                   encodings.sequence_ids(window),
+                                   offsets[window])
+            if span[0] > best[sample][0]:
+                best[sample] = span
+        return [{"score": score, "start": start, "end": end, "answer": context[start:end]}
+                for (score, start, end), context in zip(best, contexts)]
+
+    def answer_questions_about(self, context: str, questions: list, doc_stride=None, batch_size=16) -> list:
+        """Answers many questions about one context, the context is tokenized and
+        split into windows once and every question is scored against every window
+
+        Args:
+            context (str): The context shared by the questions
+            questions (list): The questions to be answered
+            doc_stride (int, optional): Overlapping tokens between context windows,
+                                        None uses the doc_stride of the class. Defaults to None.
+            batch_size (int, optional): Question and window pairs per forward pass. Defaults to 16.
+
+        Returns:
+            list(dict): Answer, score, start and end for each question
+        """
+        tokenizer = self.pipeline.tokenizer
+        windows = self.context_windows(context, self.doc_stride if doc_stride is None else doc_stride)
+        question_ids = tokenizer(list(questions), add_special_tokens=False)["input_ids"]
+        pairs = [(question, window) for question in range(len(questions)) for window in windows]
+        best = [(0.0, 0, 0)] * len(questions)
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            inputs = []
+            for question, (window_ids, window_offsets) in batch:
+                ids = question_ids[question][:self.max_question_len]
+                inputs.append(([tokenizer.cls_token_id] + ids + [tokenizer.sep_token_id]
+                               + window_ids + [tokenizer.sep_token_id],
+                               [None] + [0] * len(ids) + [None] + [1] * len(window_ids) + [None],
+                               [(0, 0)] * (len(ids) + 2) + window_offsets + [(0, 0)]))
+            length = max(len(input_ids) for input_ids, _, _ in inputs)
+            input_ids = torch.full((len(inputs), length), tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(inputs), length), dtype=torch.long)
+            token_type_ids = torch.zeros((len(inputs), length), dtype=torch.long)
+            for row, (ids, sequence_ids, _) in enumerate(inputs):
+                input_ids[row, :len(ids)] = torch.tensor(ids)
+                attention_mask[row, :len(ids)] = 1
+                # segment 1 starts after the first [SEP] and includes the last [SEP], as the tokenizer makes it
+                token_type_ids[row, sequence_ids.index(None, 1) + 1:len(ids)] = 1
+            with torch.no_grad():
+                outputs = self.pipeline.model(input_ids=input_ids,
+                                              attention_mask=attention_mask,
+                                              token_type_ids=token_type_ids)
+            for row, ((question, _), (ids, sequence_ids, offsets)) in enumerate(zip(batch, inputs)):
+                span = self._best_span(outputs.start_logits[row, :len(ids)],
+                                       outputs.end_logits[row, :len(ids)],
+                                       sequence_ids,
+                                       offsets)
+                if span[0] > best[question][0]:
+                    best[question] = span
+        return [{"score": score, "start": start, "end": end, "answer": context[start:end]}
+                for score, start, end in best]
+
+    def context_windows(self, context: str, doc_stride: int) -> list:
+        """Tokenizes the context and splits it into overlapping windows that fit
+        next to a question of max_question_len tokens, cached by context hash
+
+        Args:
+            context (str): The context to split
+            doc_stride (int): Overlapping tokens between windows
+
+        Returns:
+            list(tuple): Token ids and character offsets of each window
+        """
+        window_len = self.max_seq_len - self.max_question_len - 3
+        if not 0 <= doc_stride < window_len:
+            raise ValueError(f"doc_stride must be at least 0 and below {window_len}")
+        key = (hashlib.sha256(context.encode("utf-8")).hexdigest(), doc_stride)
+        with self._context_lock:
+            if key in self._context_cache:
+                self._context_cache.move_to_end(key)
+                return self._context_cache[key]
+        encoding = self.pipeline.tokenizer(context, add_special_tokens=False, return_offsets_mapping=True)
+        ids, offsets = encoding["input_ids"], [tuple(offset) for offset in encoding["offset_mapping"]]
+        windows = []
+        for start in range(0, max(1, len(ids)), window_len - doc_stride):
+            windows.append((ids[start:start + window_len], offsets[start:start + window_len]))
+            if start + window_len >= len(ids):
+                break
+        with self._context_lock:
+            self._context_cache[key] = windows
+            while len(self._context_cache) > self.context_cache_size:
+                self._context_cache.popitem(last=False)
+        return windows
+
+    def _best_span(self, start_logits, end_logits, sequence_ids, offsets) -> tuple:
+        "Returns score and character span of the best answer in one window"
+        # only context tokens can be answers, [CLS] is kept in the softmax like the pipeline does
+        undesired = torch.tensor([sequence_id != 1 for sequence_id in sequence_ids])
+        undesired[0] = False
+        start = start_logits.masked_fill(undesired, -10000.0).softmax(dim=-1)
+        end = end_logits.masked_fill(undesired, -10000.0).softmax(dim=-1)
+        start[0] = end[0] = 0.0
+        scores = torch.triu(torch.outer(start, end))
+        scores = torch.tril(scores, self.max_answer_len - 1)
+        index = int(scores.argmax())
+        start_index, end_index = divmod(index, scores.shape[1])
+        return float(scores[start_index, end_index]), offsets[start_index][0], offsets[end_index][1]
+
 
 class TextGenerator:
-    
-    def __init__(self):
+    checkpoint = "distilgpt2"
+
+    def __init__(self, quantized=False, prefix_cache=None):
         """Constructor of TextGenerator class, defining the transformers pipeline
+
+        Args:
+            quantized (bool, optional): Use int8 dynamic quantized linear layers, distilgpt2 keeps
+                                        its attention and MLP in Conv1D layers so only the output
+                                        layer is quantized. Defaults to False.
+            prefix_cache (PrefixCache, optional): Cache of attention keys and values for prompt
+                                                  prefixes, None disables it. Defaults to None.
         """
-        self.pipeline = pipeline("text-generation", model='distilgpt2')
+        self.pipeline = pipeline("text-generation", model=self.checkpoint)
+        if quantized:
+            self.pipeline.model = quantize_linear_layers(self.pipeline.model)
+        self.prefix_cache = prefix_cache
 
     def generate_text(self, context: str, min_length=50, max_length=500) -> list:
-        """Calls the model distilgpt2 that creates a continuation to the context string
+        """Calls the model distilgpt2 that creates a continuation to the context string,
+        runs the same sampling loop as stream_text so cached prompt prefixes are reused
 
         Args:
             context (str): The context to be appended with the model output
@@ -40,14 +227,81 @@ class TextGenerator:
         Returns:
             list(dict): The generated text in a dict nested in a list
         """
-        return self.pipeline(context, min_length=min_length, max_length=max_length)
+        return [{"generated_text": context + "".join(self.stream_text(context, min_length, max_length))}]
+
+    def stream_text(self, context: str, min_length=50, max_length=500, top_k=50):
+        """Generates the continuation one token at a time, sampling from the
+        top_k tokens like the pipeline does for distilgpt2
+
+        Args:
+            context (str): The context to be appended with the model output
+            min_length (int, optional): Min length of context and continuation in tokens. Defaults to 50.
+            max_length (int, optional): Max length of context and continuation in tokens. Defaults to 500.
+            top_k (int, optional): Number of most likely tokens to sample from. Defaults to 50.
+
+        Yields:
+            str: The next piece of the continuation text
+        """
+        tokenizer = self.pipeline.tokenizer
+        model = self.pipeline.model
+        max_length = min(max_length, model.config.n_positions)
+        # an empty context starts from the beginning of text token, the model needs one input token
+        prompt = tokenizer(context).input_ids or [tokenizer.bos_token_id]
+        reused, past = self.prefix_cache.lookup(prompt) if self.prefix_cache is not None else (0, None)
+        next_input = torch.tensor([prompt[reused:]], dtype=torch.long)
+        length = len(prompt)
+        generated = []
+        sent = ""
+        with torch.no_grad():
+            while length < max_length:
+                outputs = model(input_ids=next_input, past_key_values=past, use_cache=True)
+                if self.prefix_cache is not None and not generated:
+                    # keys and values of the whole prompt, before any generated token
+                    self.prefix_cache.put(prompt, outputs.past_key_values)
+                past = outputs.past_key_values
+                logits = outputs.logits[0, -1]
+                if length < min_length:
+                    logits[tokenizer.eos_token_id] = -float("inf")
+                token = self._sample(logits, top_k)
+                if token == tokenizer.eos_token_id:
+                    break
+                generated.append(token)
+                length += 1
+                text = tokenizer.decode(generated)
+                # wait for the rest of a character split over several tokens
+                if not text.endswith("\ufffd"):
+                    yield text[len(sent):]
+                    sent = text
+                next_input = torch.tensor([[token]], dtype=torch.long)
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens in the text
+
+        Args:
+            text (str): Text to tokenize
+
+        Returns:
+            int: Number of tokens
+        """
+        return len(self.pipeline.tokenizer(text).input_ids)
+
+    def _sample(self, logits, top_k) -> int:
+        "Samples the next token from the top_k most likely tokens"
+        values, indices = logits.topk(top_k)
+        return int(indices[torch.multinomial(values.softmax(dim=-1), 1)])
 
 class SentimentAnalyser:
-    
-    def __init__(self):
+    checkpoint = "distilbert-base-uncased-finetuned-sst-2-english"
+
+    def __init__(self, quantized=False):
         """Constructor for sentiment analysis, calls the predefined transformers pipeline
+
+        Args:
+            quantized (bool, optional): Use int8 dynamic quantized linear layers. Defaults to False.
         """
-        self.pipeline = pipeline("sentiment-analysis")
+        self.pipeline = pipeline("sentiment-analysis", model=self.checkpoint)
+        if quantized:
+            self.pipeline.model = quantize_linear_layers(self.pipeline.model)
 
     def analyse_text(self, text: str) -> list:
         """Analyzes the text sentiment by calling the predefined pipeline
@@ -58,34 +312,157 @@ class SentimentAnalyser:
         Returns:
             list(dict): The result in a dict nested in a list
         """
-        return self.pipeline(text)
+        return self.pipeline(text, truncation=True)
+
+    def analyse_texts(self, texts: list) -> list:
+        """Analyzes the sentiment of several texts in one padded batch
+
+        Args:
+            texts (list): The texts to be sentiment analyzed
+
+        Returns:
+            list(dict): One result per text in the same order
+        """
+        # texts over the 512 token limit are cut instead of failing the batch
+        return self.pipeline(texts, truncation=True)
 
 class ImageClassifier:
+    checkpoint = "openai/clip-vit-base-patch32"
 
-    def __init__(self, labels = ['cat', 'dog', 'banana']):
+    def __init__(self, labels = ['cat', 'dog', 'banana'], label_cache_size=1024, quantized=False):
         """Constructor for a model that is classifying images from classes as initialized
 
         Args:
             labels (list, optional): List of classes to be added in the model. Defaults to ['cat', 'dog', 'banana'].
+            label_cache_size (int, optional): Max number of label text embeddings kept in memory. Defaults to 1024.
+            quantized (bool, optional): Use int8 dynamic quantized linear layers. Defaults to False.
         """
         self.labels = labels
-        self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+        self.model = CLIPModel.from_pretrained(self.checkpoint)
+        if quantized:
+            self.model = quantize_linear_layers(self.model)
+        self.processor = CLIPProcessor.from_pretrained(self.checkpoint)
+        self.label_cache_size = label_cache_size
+        self._label_cache = OrderedDict()
+        self._label_lock = threading.Lock()
 
-    def classify(self, image) -> dict:
+    def classify(self, image, labels=None) -> dict:
         """Classifies an input image
 
         Args:
             image (): The image to be classified
+            labels (list, optional): Classes to compare the image to. Defaults to the model labels.
 
         Returns:
             dict: How well the image corresponds to the model classes
         """
-        inputs = self.processor(text=self.labels, images=image, return_tensors="pt", padding=True)
-        outputs = self.model(**inputs)
-        logits_per_image = outputs.logits_per_image # this is the image-text similarity score
-        probs = logits_per_image.softmax(dim=1).detach().numpy()[0] # we can take the softmax to get the label probabilities
-        return self._yield_output(probs, self.labels)
+        return self.classify_batch([image], [labels])[0]
+
+    def classify_batch(self, images: list, labels_list: list, return_embeddings=False):
+        """Classifies several images with one vision forward pass, each
+        image can have its own classes
+
+        Args:
+            images (list): The images to be classified
+            labels_list (list): Classes for each image, None uses the model labels
+            return_embeddings (bool, optional): Also return the image embeddings. Defaults to False.
+
+        Returns:
+            list(dict): How well each image corresponds to its classes, with return_embeddings
+                        a tuple of that list and the normalized embeddings as a numpy array
+        """
+        image_embeds = self.image_embeddings(images)
+        results = self.classify_embeddings(image_embeds, labels_list)
+        return (results, image_embeds.numpy()) if return_embeddings else results
+
+    def classify_embeddings(self, image_embeds, labels_list: list) -> list:
+        """Classifies images from their embeddings, only labels run through the model
+
+        Args:
+            image_embeds (torch.Tensor): Normalized image embeddings, one row per image
+            labels_list (list): Classes for each image, None uses the model labels
+
+        Returns:
+            list(dict): How well each image corresponds to its classes
+        """
+        results = []
+        for image_embed, labels in zip(image_embeds, labels_list):
+            labels = labels or self.labels
+            probs = self._probabilities(image_embed[None], self.label_embeddings(labels))[0]
+            results.append(self._yield_output(probs, labels))
+        return results
+
+    def score_embedding(self, embedding, labels=None) -> dict:
+        """Classifies a stored image embedding without the vision tower
+
+        Args:
+            embedding (np.ndarray): Image embedding from classify_batch, float16 precision is enough
+            labels (list, optional): Classes to compare the image to. Defaults to the model labels.
+
+        Returns:
+            dict: How well the image corresponds to the classes
+        """
+        embedding = torch.as_tensor(embedding, dtype=torch.float32)
+        if embedding.shape != (self.model.config.projection_dim,):
+            raise ValueError(f"Embedding must have {self.model.config.projection_dim} values.")
+        return self.classify_embeddings((embedding / embedding.norm())[None], [labels])[0]
+
+    def text_embedding(self, text: str):
+        """Embeds a text in the same space as the images, for searching images by text
+
+        Args:
+            text (str): Description of an image
+
+        Returns:
+            np.ndarray: Normalized text embedding
+        """
+        return self.label_embeddings([text])[0].numpy()
+
+    def image_embeddings(self, images: list) -> torch.Tensor:
+        """Runs the images through the vision tower only
+
+        Args:
+            images (list): Images to embed
+
+        Returns:
+            torch.Tensor: Normalized image embeddings, one row per image
+        """
+        inputs = self.processor(images=images, return_tensors="pt")
+        with torch.no_grad():
+            embeds = self.model.get_image_features(**inputs)
+        return embeds / embeds.norm(dim=-1, keepdim=True)
+
+    def label_embeddings(self, labels: list) -> torch.Tensor:
+        """Returns the text embeddings of the labels, only labels missing
+        from the cache are run through the text tower
+
+        Args:
+            labels (list): Class labels
+
+        Returns:
+            torch.Tensor: Normalized label embeddings, one row per label
+        """
+        with self._label_lock:
+            found = {label: self._label_cache[label] for label in labels if label in self._label_cache}
+            for label in found:
+                self._label_cache.move_to_end(label)
+        missing = [label for label in dict.fromkeys(labels) if label not in found]
+        if missing:
+            inputs = self.processor(text=missing, return_tensors="pt", padding=True)
+            with torch.no_grad():
+                embeds = self.model.get_text_features(**inputs)
+            embeds = embeds / embeds.norm(dim=-1, keepdim=True)
+            found.update(zip(missing, embeds))
+            with self._label_lock:
+                self._label_cache.update(zip(missing, embeds))
+                while len(self._label_cache) > self.label_cache_size:
+                    self._label_cache.popitem(last=False)
+        return torch.stack([found[label] for label in labels])
+
+    def _probabilities(self, image_embeds, label_embeds):
+        "Returns the label probabilities per image from normalized embeddings"
+        logits_per_image = self.model.logit_scale.exp() * image_embeds @ label_embeds.t() # this is the image-text similarity score
+        return logits_per_image.softmax(dim=1).detach().numpy() # we can take the softmax to get the label probabilities
 
     def _yield_output(self, probs, labels) -> dict:
         "Returns a dict mapping from label to probability"
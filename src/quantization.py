@@ -0,0 +1,171 @@
+"""Compares the int8 quantized models with fp32 on a fixed sample set
+Reports latency, memory and how often the outputs agree, run from the repository root:
+    python src/quantization.py [model names] [--output report.json]
+"""
+import argparse
+import json
+import statistics
+import time
+from PIL import Image
+import torch
+
+import models
+from registry import estimate_memory
+
+QA_SAMPLES = [
+    ("What is the capital of Sweden?",
+     "Stockholm is the capital and largest city of Sweden. It is spread over fourteen islands."),
+    ("When was the bridge finished?",
+     "Construction of the bridge began in 1995 and it was finished in the summer of 2000."),
+    ("Who wrote the report?",
+     "The report was written by the research group at the university and published last year."),
+    ("How many people live in the town?",
+     "The town is small and quiet, about 4000 people live there all year round."),
+    ("What does the model classify?",
+     "The model classifies images into classes that the user provides as text labels."),
+]
+
+SENTIMENT_SAMPLES = [
+    "I love how fast the new version is.",
+    "This was the worst service I have ever had.",
+    "The package arrived on time and works as expected.",
+    "I am not sure what to think about the ending of the movie.",
+    "Terrible battery life, it barely lasts an hour.",
+    "What a wonderful surprise, thank you all so much!",
+]
+
+TEXT_SAMPLES = [
+    "The weather in Stockholm today is",
+    "Machine learning models are",
+    "Once upon a time there was a",
+    "The most important thing about databases is",
+]
+
+IMAGE_LABELS = ["a red picture", "a green picture", "a blue picture", "a yellow picture"]
+IMAGE_COLORS = [(220, 30, 30), (30, 200, 30), (30, 30, 220), (230, 220, 40), (120, 120, 120)]
+
+
+def _image_samples() -> list:
+    "Plain color and split images, made here so no files are needed"
+    images = [Image.new("RGB", (320, 240), color) for color in IMAGE_COLORS]
+    for left, right in zip(IMAGE_COLORS, IMAGE_COLORS[1:]):
+        image = Image.new("RGB", (320, 240), left)
+        image.paste(Image.new("RGB", (160, 240), right), (160, 0))
+        images.append(image)
+    return images
+
+
+def _run_qa(model) -> list:
+    "Answers the samples in one batch through answer_questions, the path /qa/ serves"
+    questions, contexts = zip(*QA_SAMPLES)
+    return model.answer_questions(list(questions), list(contexts))
+
+
+def _agree_qa(reference: list, outputs: list) -> dict:
+    return {"answer_agreement": statistics.mean(a["answer"] == b["answer"] for a, b in zip(reference, outputs)),
+            "mean_score_difference": statistics.mean(abs(a["score"] - b["score"]) for a, b in zip(reference, outputs))}
+
+
+def _run_sentiment(model) -> list:
+    return [model.analyse_text(text)[0] for text in SENTIMENT_SAMPLES]
+
+
+def _agree_sentiment(reference: list, outputs: list) -> dict:
+    return {"label_agreement": statistics.mean(a["label"] == b["label"] for a, b in zip(reference, outputs)),
+            "mean_score_difference": statistics.mean(abs(a["score"] - b["score"]) for a, b in zip(reference, outputs))}
+
+
+def _run_text(model) -> list:
+    "Next token logits, generation itself samples so it can not be compared"
+    tokenizer = model.pipeline.tokenizer
+    with torch.no_grad():
+        return [model.pipeline.model(**tokenizer(text, return_tensors="pt")).logits[0, -1]
+                for text in TEXT_SAMPLES]
+
+
+def _agree_text(reference: list, outputs: list) -> dict:
+    return {"next_token_agreement": statistics.mean(int(a.argmax()) == int(b.argmax())
+                                                    for a, b in zip(reference, outputs)),
+            "top5_overlap": statistics.mean(len(set(a.topk(5).indices.tolist()) & set(b.topk(5).indices.tolist())) / 5
+                                            for a, b in zip(reference, outputs))}
+
+
+def _run_image(model) -> list:
+    return [model.classify(image, IMAGE_LABELS) for image in _image_samples()]
+
+
+def _agree_image(reference: list, outputs: list) -> dict:
+    return {"top_label_agreement": statistics.mean(max(a, key=a.get) == max(b, key=b.get)
+                                                   for a, b in zip(reference, outputs)),
+            "mean_probability_difference": statistics.mean(abs(float(a[label]) - float(b[label]))
+                                                           for a, b in zip(reference, outputs)
+                                                           for label in a)}
+
+
+COMPARISONS = {
+    "question_answering": (models.QA, _run_qa, _agree_qa),
+    "sentiment_analysis": (models.SentimentAnalyser, _run_sentiment, _agree_sentiment),
+    "text_generator": (models.TextGenerator, _run_text, _agree_text),
+    "image_classifier": (models.ImageClassifier, _run_image, _agree_image),
+}
+
+
+def _measure(model, run, repeats: int) -> tuple:
+    "Returns outputs and the latency per sample set in milliseconds"
+    outputs = run(model)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(model)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return outputs, latencies
+
+
+def compare(name: str, repeats: int = 3) -> dict:
+    """Loads a model in fp32 and int8 and compares them on the fixed samples
+
+    Args:
+        name (str): Model name as used by the server
+        repeats (int, optional): Timed runs over the sample set. Defaults to 3.
+
+    Returns:
+        dict: Memory, latency and output agreement of both variants
+    """
+    factory, run, agree = COMPARISONS[name]
+    report = {"model": name, "checkpoint": factory.checkpoint, "repeats": repeats}
+    reference = None
+    for variant, quantized in [("fp32", False), ("int8", True)]:
+        model = factory(quantized=quantized)
+        outputs, latencies = _measure(model, run, repeats)
+        report[variant] = {"memory_mb": round(estimate_memory(model) / 1024 ** 2, 1),
+                           "median_latency_ms": round(statistics.median(latencies), 1),
+                           "min_latency_ms": round(min(latencies), 1)}
+        if reference is None:
+            reference = outputs
+        else:
+            report["agreement"] = agree(reference, outputs)
+        del model
+    report["speedup"] = round(report["fp32"]["median_latency_ms"] / report["int8"]["median_latency_ms"], 2)
+    report["memory_saved_mb"] = round(report["fp32"]["memory_mb"] - report["int8"]["memory_mb"], 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("models", nargs="*", default=list(COMPARISONS),
+                        help=f"models to compare, default all of {', '.join(COMPARISONS)}")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs over the sample set")
+    parser.add_argument("--output", default="", help="also write the report to this json file")
+    args = parser.parse_args()
+    unknown = [name for name in args.models if name not in COMPARISONS]
+    if unknown:
+        parser.error(f"unknown models {unknown}")
+    reports = [compare(name, args.repeats) for name in args.models]
+    print(json.dumps(reports, indent=2))
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(reports, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
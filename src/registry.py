@@ -0,0 +1,175 @@
+"""Registry that keeps several machine learning models loaded at once
+and evicts the least recently used idle model when over the memory budget
+"""
+import gc
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def estimate_memory(model) -> int:
+    """Estimates the memory used by the torch weights in a model class
+
+    Args:
+        model: Instance of one of the classes in models.py
+
+    Returns:
+        int: Size of all weights and buffers in bytes
+    """
+    seen = set()
+    total = 0
+    for attribute in vars(model).values():
+        # pipelines keep the torch module in .model
+        module = getattr(attribute, "model", attribute)
+        if not hasattr(module, "state_dict"):
+            continue
+        for value in module.state_dict().values():
+            # int8 quantized linear layers store (weight, bias) tuples
+            for tensor in value if isinstance(value, tuple) else (value,):
+                if not hasattr(tensor, "data_ptr") or tensor.data_ptr() in seen:
+                    continue
+                seen.add(tensor.data_ptr())
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class _Entry:
+    "Bookkeeping for one loaded model"
+
+    def __init__(self, model, memory: int, load_time: float):
+        self.model = model
+        self.memory = memory
+        self.load_time = load_time
+        self.last_used = time.time()
+        self.users = 0
+
+
+class ModelRegistry:
+    """Loads models on demand and keeps them resident between requests
+    Methods: __init__
+            load
+            unload
+            use
+            status
+    """
+
+    def __init__(self, factories: dict, memory_budget_mb: float = 0):
+        """Constructor of the registry
+
+        Args:
+            factories (dict): Model name mapped to a callable creating the model
+            memory_budget_mb (float, optional): Max memory for loaded models in
+                                                megabytes, 0 is unlimited. Defaults to 0.
+        """
+        self.factories = {self._key(name): factory for name, factory in factories.items()}
+        self.memory_budget = int(memory_budget_mb * 1024 ** 2)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_locks = {name: threading.Lock() for name in self.factories}
+
+    @staticmethod
+    def _key(name) -> str:
+        "Returns the plain string name for enum members and strings"
+        return getattr(name, "value", name)
+
+    def load(self, name) -> _Entry:
+        """Loads a model unless it is already loaded
+
+        Args:
+            name (str): Name of the model
+
+        Returns:
+            _Entry: The registry entry of the loaded model
+        """
+        name = self._key(name)
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+                    return self._entries[name]
+            start = time.perf_counter()
+            model = self.factories[name]()
+            entry = _Entry(model, estimate_memory(model), time.perf_counter() - start)
+            with self._lock:
+                self._entries[name] = entry
+                self._evict(keep=name)
+        return entry
+
+    def unload(self, name) -> bool:
+        """Removes a model from memory if no request is using it
+
+        Args:
+            name (str): Name of the model
+
+        Returns:
+            bool: True if the model was unloaded
+        """
+        name = self._key(name)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.users > 0:
+                return False
+            del self._entries[name]
+        gc.collect()
+        return True
+
+    @contextmanager
+    def use(self, name):
+        """Context manager that hands out a loaded model and protects it
+        from eviction while the block runs
+
+        Args:
+            name (str): Name of the model
+        """
+        name = self._key(name)
+        while True:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    entry.users += 1
+                    self._entries.move_to_end(name)
+                    break
+            self.load(name)
+        try:
+            yield entry.model
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.time()
+
+    def _evict(self, keep: str = ""):
+        "Unloads idle models in least recently used order until within budget"
+        if not self.memory_budget:
+            return
+        evicted = False
+        while sum(entry.memory for entry in self._entries.values()) > self.memory_budget:
+            idle = [name for name, entry in self._entries.items()
+                    if entry.users == 0 and name != keep]
+            if not idle:
+                break
+            del self._entries[idle[0]]
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def status(self) -> dict:
+        """Reports which models are loaded and what they cost in memory
+
+        Returns:
+            dict: Budget, total memory and one entry per known model
+        """
+        now = time.time()
+        with self._lock:
+            loaded = {name: {"loaded": True,
+                             "memory_mb": round(entry.memory / 1024 ** 2, 1),
+                             "load_time_s": round(entry.load_time, 2),
+                             "idle_s": round(now - entry.last_used, 1),
+                             "in_use": entry.users}
+                      for name, entry in self._entries.items()}
+            total = sum(entry.memory for entry in self._entries.values())
+        models = {name: loaded.get(name, {"loaded": False, "loading": self._load_locks[name].locked()})
+                  for name in self.factories}
+        return {"memory_budget_mb": round(self.memory_budget / 1024 ** 2, 1),
+                "memory_used_mb": round(total / 1024 ** 2, 1),
+                "models": models}
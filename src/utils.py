@@ -1,6 +1,88 @@
-from PIL import Image
+import base64
+import binascii
+from PIL import Image, ImageOps
 from io import BytesIO
+import numpy as np
+from fastapi import HTTPException, UploadFile
 
-def read_imagefile(file) -> Image.Image:
+def read_imagefile(file, target_size: int = 224, max_pixels: int = 64_000_000) -> Image.Image:
+    """Decodes an image close to the size the model uses
+
+    Args:
+        file (bytes): The uploaded file contents
+        target_size (int, optional): Smallest side the model needs. Defaults to 224.
+        max_pixels (int, optional): Largest accepted image in pixels. Defaults to 64 million.
+
+    Raises:
+        ValueError: if the image has more than max_pixels pixels
+
+    Returns:
+        Image.Image: RGB image turned upright from its EXIF orientation
+    """
     image = Image.open(BytesIO(file))
-    return image
\ No newline at end of file
+    # the header gives the size, a small file can still decode to gigabytes
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ValueError(f"Image has {width * height} pixels, the limit is {max_pixels}")
+    # JPEG decodes at 1/2, 1/4 or 1/8 scale while both sides stay above target_size
+    image.draft("RGB", (target_size, target_size))
+    image = ImageOps.exif_transpose(image)
+    if image.mode == "P":
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    return image.convert("RGB")
+
+async def read_upload(file: UploadFile, max_bytes: int, chunk_size: int = 1024 * 1024) -> bytes:
+    """Reads an upload in chunks and stops at the size limit
+
+    Args:
+        file (UploadFile): The uploaded file
+        max_bytes (int): Largest accepted file
+        chunk_size (int, optional): Bytes read at a time. Defaults to 1 MB.
+
+    Returns:
+        bytes: The file contents
+    """
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413,
+                                detail=f"{file.filename} is larger than {max_bytes // 1024 ** 2} MB.")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def encode_embedding(embedding) -> str:
+    """Packs an embedding as base64 of little endian float16 values, 2 bytes per value
+
+    Args:
+        embedding (np.ndarray): One embedding vector
+
+    Returns:
+        str: The base64 text
+    """
+    return base64.b64encode(np.asarray(embedding, dtype="<f2").tobytes()).decode("ascii")
+
+def decode_embedding(text: str) -> np.ndarray:
+    """Unpacks an embedding made by encode_embedding
+
+    Args:
+        text (str): The base64 text
+
+    Returns:
+        np.ndarray: float32 embedding vector
+    """
+    try:
+        data = base64.b64decode(text, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("Embedding is not valid base64.")
+    if not data or len(data) % 2:
+        raise ValueError("Embedding must hold float16 values.")
+    return np.frombuffer(data, dtype="<f2").astype(np.float32)
@@ -0,0 +1,139 @@
+"""Serving mode with several inference worker processes (Linux)
+The models are loaded once in the parent process before fork so the workers
+share the weight pages copy-on-write, the workers accept connections from one
+listening socket and the kernel spreads the connections over them
+"""
+import gc
+import os
+import signal
+import socket
+import time
+import uvicorn
+
+
+def worker_torch_threads(workers: int, torch_threads: int = 0, inference_threads: int = 1) -> int:
+    """Intra-op threads per forward pass so the passes of all workers together
+    use each core once
+
+    Args:
+        workers (int): Number of worker processes
+        torch_threads (int, optional): Fixed thread count, 0 divides the cores. Defaults to 0.
+        inference_threads (int, optional): Forward passes each worker runs at once. Defaults to 1.
+
+    Returns:
+        int: Torch threads for each forward pass
+    """
+    return torch_threads or max(1, (os.cpu_count() or 1) // (workers * inference_threads))
+
+
+class WorkerPool:
+    """Forks uvicorn workers sharing preloaded models and restarts crashed workers
+    Methods: __init__
+            serve
+    """
+
+    def __init__(self, app, registry, executor, preload: list, workers: int,
+                 host: str = "127.0.0.1", port: int = 8000, torch_threads: int = 0,
+                 max_restarts: int = 5, restart_window: float = 300):
+        """Constructor of the pool
+
+        Args:
+            app (FastAPI): The app every worker serves
+            registry (ModelRegistry): Registry holding the models
+            executor (InferenceExecutor): Inference pool of the app, one thread per
+                                          model in each worker unless its size is set
+            preload (list): Names of the models loaded before fork
+            workers (int): Number of worker processes
+            host (str, optional): Address to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on. Defaults to 8000.
+            torch_threads (int, optional): Torch threads per forward pass, 0 divides the cores.
+                                           Defaults to 0.
+            max_restarts (int, optional): Worker crashes within restart_window before giving up.
+                                          Defaults to 5.
+            restart_window (float, optional): Seconds the crashes are counted over.
+                                              Defaults to 300.
+        """
+        self.app = app
+        self.registry = registry
+        self.executor = executor
+        self.preload = preload
+        self.workers = workers
+        self.host = host
+        self.port = port
+        # the workers already run in parallel, each runs one forward pass per model at a time by default
+        self.inference_threads = executor.max_workers or executor.min_workers
+        self.torch_threads = worker_torch_threads(workers, torch_threads, self.inference_threads)
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self._children = set()
+        self._stopping = False
+
+    def serve(self):
+        "Loads the models, starts the workers and waits until stopped"
+        for name in self.preload:
+            self.registry.load(name)
+        # objects created so far are never scanned by the collector again,
+        # which would otherwise write to and copy their pages in every worker
+        gc.collect()
+        gc.freeze()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(2048)
+        sock.set_inheritable(True)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        print(f"Serving on http://{self.host}:{self.port} with {self.workers} workers "
+              f"of {self.inference_threads} x {self.torch_threads} torch threads, preloaded {self.preload}")
+        for _ in range(self.workers):
+            self._spawn(sock)
+        crashes = []
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            self._children.discard(pid)
+            if self._stopping:
+                continue
+            now = time.time()
+            crashes = [crash for crash in crashes if now - crash < self.restart_window] + [now]
+            if len(crashes) > self.max_restarts:
+                print(f"Workers crashed {len(crashes)} times in {self.restart_window} s, giving up")
+                self._stop(signal.SIGTERM, None)
+                continue
+            # a worker that dies at startup would otherwise be forked again in a tight loop
+            delay = min(30, 2 ** (len(crashes) - 1))
+            print(f"Worker {pid} exited with status {status}, starting a new worker in {delay} s")
+            deadline = now + delay
+            while not self._stopping and time.time() < deadline:
+                time.sleep(0.1)
+            if not self._stopping:
+                self._spawn(sock)
+        sock.close()
+
+    def _spawn(self, sock: socket.socket):
+        "Forks one worker that serves the app on the shared socket"
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        import torch
+        torch.set_num_threads(self.torch_threads)
+        self.executor.max_workers = self.inference_threads
+        server = uvicorn.Server(uvicorn.Config(self.app))
+        server.run(sockets=[sock])
+        os._exit(0)
+
+    def _stop(self, signum, frame):
+        "Stops the workers gracefully on SIGTERM or SIGINT"
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self._children.discard(pid)
@@ -0,0 +1,247 @@
+"""Supervisor for the machine learning server (Linux)
+Runs ./src/main.py in a detached process that outlives the Streamlit page,
+records it in a state file, restarts it when it crashes and stops it gracefully.
+    python supervisor.py start|stop|status|run
+"""
+import argparse
+import fcntl
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_COMMAND = [sys.executable, os.path.join(ROOT_DIR, "src", "main.py")]
+
+
+class Supervisor():
+    """Starts, restarts and stops the machine learning server
+    Methods: __init__
+            start
+            stop
+            status
+            run
+    """
+    def __init__(self,
+                 command: list = None,
+                 run_dir: str = os.path.join(ROOT_DIR, "run"),
+                 max_restarts: int = 5,
+                 restart_window: float = 300,
+                 stop_timeout: float = 15) -> None:
+        """Initializes class
+
+        Args:
+            command (list, optional): Server command. Defaults to SERVER_COMMAND.
+            run_dir (str, optional): Directory for the lock, state and log files.
+                                     Defaults to ./run.
+            max_restarts (int, optional): Crashes within restart_window before giving up.
+                                          Defaults to 5.
+            restart_window (float, optional): Seconds the crashes are counted over.
+                                              Defaults to 300.
+            stop_timeout (float, optional): Seconds to wait for a graceful stop before
+                                            the server is killed. Defaults to 15.
+        """
+        self.command = command or SERVER_COMMAND
+        self.run_dir = run_dir
+        self.lock_file = os.path.join(run_dir, "ml_server.lock")
+        self.state_file = os.path.join(run_dir, "ml_server.json")
+        self.log_file = os.path.join(run_dir, "ml_server.log")
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.stop_timeout = stop_timeout
+        self._server = None
+        self._stopping = False
+
+    def start(self, timeout: float = 10) -> int:
+        """Starts the supervisor in the background unless it already runs
+
+        Args:
+            timeout (float, optional): Seconds to wait for it to start. Defaults to 10.
+
+        Returns:
+            int: process id of the supervisor, 0 if it did not start
+        """
+        state = self.status()
+        if state["running"]:
+            return state["pid"]
+        os.makedirs(self.run_dir, exist_ok=True)
+        with open(self.log_file, "ab") as log:
+            # a new session so closing the terminal or Streamlit does not stop it
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-dir", self.run_dir,
+                              "run", "--"] + self.command,
+                             cwd=ROOT_DIR,
+                             stdin=subprocess.DEVNULL,
+                             stdout=log,
+                             stderr=subprocess.STDOUT,
+                             start_new_session=True)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            state = self.status()
+            if state["running"] and state["pid"]:
+                return state["pid"]
+            time.sleep(0.1)
+        return 0
+
+    def stop(self, timeout: float = 0) -> bool:
+        """Stops the server and the supervisor
+
+        Args:
+            timeout (float, optional): Seconds to wait, 0 waits stop_timeout
+                                       and a little more. Defaults to 0.
+
+        Returns:
+            bool: True if nothing is running anymore
+        """
+        state = self.status()
+        if not state["running"]:
+            return True
+        try:
+            os.kill(state["pid"], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.time() + (timeout or self.stop_timeout + 5)
+        while time.time() < deadline:
+            if not self.status()["running"]:
+                return True
+            time.sleep(0.1)
+        return False
+
+    def status(self) -> dict:
+        """Reads the state file, the lock shows whether the supervisor runs
+
+        Returns:
+            dict: running, pid, server_pid, restarts and started
+        """
+        state = {"running": self._locked(), "pid": 0, "server_pid": 0, "restarts": 0, "started": 0}
+        if state["running"]:
+            try:
+                with open(self.state_file) as state_file:
+                    state.update(json.load(state_file))
+            except (OSError, ValueError):
+                pass
+        return state
+
+    def _locked(self) -> bool:
+        "True if a supervisor holds the lock"
+        try:
+            with open(self.lock_file, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _write_state(self, restarts: int, started: float):
+        "Replaces the state file in one step so readers never see half of it"
+        state = {"pid": os.getpid(),
+                 "server_pid": self._server.pid if self._server else 0,
+                 "restarts": restarts,
+                 "started": started}
+        temporary = self.state_file + ".tmp"
+        with open(temporary, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temporary, self.state_file)
+
+    def run(self) -> int:
+        """Runs the server in the foreground and restarts it when it crashes,
+        returns when stopped with SIGTERM or SIGINT or after too many crashes
+
+        Returns:
+            int: exit code
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        lock = open(self.lock_file, "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("The ML server supervisor is already running")
+            return 1
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        started = time.time()
+        restarts = 0
+        crashes = []
+        try:
+            while not self._stopping:
+                self._server = subprocess.Popen(self.command, cwd=ROOT_DIR)
+                self._write_state(restarts, started)
+                print(f"Started ML server {self._server.pid}", flush=True)
+                code = self._wait_server()
+                if code is None or code == 0:
+                    break
+                now = time.time()
+                crashes = [crash for crash in crashes if now - crash < self.restart_window] + [now]
+                if len(crashes) > self.max_restarts:
+                    print(f"ML server crashed {len(crashes)} times in {self.restart_window} s, giving up",
+                          flush=True)
+                    return 1
+                # wait longer after each crash, e.g. for memory to be freed after an out of memory kill
+                delay = min(30, 2 ** (len(crashes) - 1))
+                print(f"ML server exited with {code}, restarting in {delay} s", flush=True)
+                restarts += 1
+                deadline = time.time() + delay
+                while not self._stopping and time.time() < deadline:
+                    time.sleep(0.1)
+            return 0
+        finally:
+            self._stop_server()
+            try:
+                os.remove(self.state_file)
+            except OSError:
+                pass
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _wait_server(self):
+        "Waits for the server to exit, returns its exit code or None when stopping"
+        while not self._stopping:
+            try:
+                return self._server.wait(0.5)
+            except subprocess.TimeoutExpired:
+                pass
+        return None
+
+    def _stop(self, signum, frame):
+        "Signal handler, the server is stopped when run returns"
+        self._stopping = True
+
+    def _stop_server(self):
+        "Asks the server to stop and kills it after stop_timeout"
+        if self._server is None or self._server.poll() is not None:
+            return
+        self._server.terminate()
+        try:
+            self._server.wait(self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            self._server.kill()
+            self._server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["start", "stop", "status", "run"],
+                        help="run keeps the supervisor in the foreground")
+    parser.add_argument("--run-dir", default=os.path.join(ROOT_DIR, "run"),
+                        help="directory for the lock, state and log files")
+    parser.add_argument("server_command", nargs=argparse.REMAINDER,
+                        help="server command after --, default python src/main.py")
+    args = parser.parse_args()
+    server_command = args.server_command[1:] if args.server_command[:1] == ["--"] else args.server_command
+    supervisor = Supervisor(server_command, args.run_dir)
+    if args.command == "start":
+        pid = supervisor.start()
+        print(f"Supervisor running with pid {pid}" if pid else "Supervisor did not start")
+    elif args.command == "stop":
+        print("Stopped" if supervisor.stop() else "Supervisor did not stop")
+    elif args.command == "status":
+        print(json.dumps(supervisor.status()))
+    else:
+        sys.exit(supervisor.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,293 @@
 """Help classes and functions for group2 streamlit ml app
 """
-import sys
-import subprocess
 import sqlite3
 import json
-from datetime import datetime
+import ast
+import atexit
+import base64
+import binascii
+import hashlib
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from typing import NamedTuple
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import pandas as pd
+from PIL import Image, ImageOps
+from supervisor import Supervisor
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = "application/msgpack"
+
+
+class Answer(NamedTuple):
+    "Answer of the question answering model"
+    answer: str
+    score: float
+
+
+class Sentiment(NamedTuple):
+    "Result of the sentiment analysis model"
+    label: str
+    score: float
+
+
+class Classification(NamedTuple):
+    "Result of the image classifier, embedding is None unless requested"
+    probabilities: dict
+    embedding: bytes = None
+
+
+class MLClient():
+    """Shared HTTP transport for the machine learning classes
+    keeps connections alive in a pool, uses timeouts and retries
+    transient errors with backoff
+    Methods: __init__
+            request
+            get
+            post
+            put
+            delete
+            decode
+            map
+    """
+    def __init__(self,
+                 pool_size: int = 10,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 120,
+                 retries: int = 3,
+                 backoff_factor: float = 0.5) -> None:
+        """Initializes class
+
+        Args:
+            pool_size (int, optional): Connections kept alive and requests
+                                       in flight in map. Defaults to 10.
+            connect_timeout (float, optional): Seconds to wait for a connection.
+                                               Defaults to 3.05.
+            read_timeout (float, optional): Seconds to wait for the server to answer.
+                                            Defaults to 120.
+            retries (int, optional): Retries on connection errors and 502, 503, 504,
+                                     never after the request was sent and the
+                                     answer timed out. Defaults to 3.
+            backoff_factor (float, optional): Sleeps backoff_factor * 2 ** retry between
+                                              retries. Defaults to 0.5.
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        # a read timeout means the server is still working on the request,
+        # sending it again would only run the same inference once more
+        retry = Retry(total=retries,
+                      read=0,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if msgpack is not None:
+            self.session.headers["Accept"] = f"{MSGPACK}, application/json"
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Sends a request on a pooled connection with the default timeout
+
+        Args:
+            method (str): http method
+            url (str): adress to send to
+
+        Returns:
+            requests.Response: the server response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        "Sends a GET request"
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        "Sends a POST request"
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        "Sends a PUT request"
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        "Sends a DELETE request"
+        return self.request("DELETE", url, **kwargs)
+
+    def decode(self, response: requests.Response):
+        """Decodes a model response, MessagePack or JSON as the server chose
+
+        Args:
+            response (requests.Response): the server response
+
+        Returns:
+            dict or list: the decoded body, raises requests.HTTPError on an error status
+        """
+        response.raise_for_status()
+        if response.headers.get("content-type", "").startswith(MSGPACK):
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
+    def map(self, function, items, max_in_flight: int = 0) -> list:
+        """Calls function on every item with several requests in flight at once
+
+        Args:
+            function (callable): called with one item, e.g. a bound MLModel method
+            items (iterable): inputs to the function
+            max_in_flight (int, optional): calls running at once, 0 uses the pool size.
+                                           Defaults to 0.
+
+        Returns:
+            list: function results in the same order as items
+        """
+        with ThreadPoolExecutor(max_workers=max_in_flight or self.pool_size) as pool:
+            return list(pool.map(function, items))
+
+
+_shared_client = None
+_shared_lock = threading.Lock()
+
+
+def get_client() -> MLClient:
+    """Returns the MLClient shared by all machine learning classes
+
+    Returns:
+        MLClient: the shared client
+    """
+    global _shared_client
+    # streamlit runs each browser session in its own thread
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = MLClient()
+    return _shared_client
+
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+
+def memoize(key, max_age: float, compute):
+    """Returns the value computed for key within max_age seconds,
+    so streamlit reruns close together share one server request
+
+    Args:
+        key (hashable): what the value is
+        max_age (float): seconds a value is reused
+        compute (callable): computes the value without arguments
+
+    Returns:
+        the remembered or newly computed value
+    """
+    with _memo_lock:
+        remembered = _memo.get(key)
+    if remembered is not None and time.time() - remembered[0] < max_age:
+        return remembered[1]
+    value = compute()
+    with _memo_lock:
+        _memo[key] = (time.time(), value)
+    return value
+
+
+def forget(key):
+    "Drops a memoized value so the next call computes it again"
+    with _memo_lock:
+        _memo.pop(key, None)
+
+
+def parse_metrics(text: str) -> list:
+    """Parses the Prometheus text format from the server
+
+    Args:
+        text (str): body of /metrics
+
+    Returns:
+        list: (name, labels dict, value) for every sample
+    """
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        name, _, labels = series.partition("{")
+        label_dict = {}
+        for pair in labels.rstrip("}").split('",') if labels else []:
+            key, _, label_value = pair.partition('="')
+            label_dict[key] = label_value.rstrip('"')
+        samples.append((name, label_dict, float(value)))
+    return samples
+
+
+def summarize_metrics(samples: list) -> dict:
+    """Sums up the server metrics for the sidebar, requests to /metrics are left out
+
+    Args:
+        samples (list): output of parse_metrics
+
+    Returns:
+        dict: requests, errors, in flight, mean latency, tokens per second,
+              mean image decode time and memory per loaded model
+    """
+    totals = {}
+    loaded = {}
+    memory = {}
+    for name, labels, value in samples:
+        if labels.get("endpoint") == "/metrics":
+            continue
+        if name == "ml_http_requests_total" and int(labels["status"]) >= 400:
+            totals["errors"] = totals.get("errors", 0) + value
+        if name == "ml_model_loaded":
+            loaded[labels["model"]] = value
+        elif name == "ml_model_memory_bytes":
+            memory[labels["model"]] = value
+        else:
+            totals[name] = totals.get(name, 0) + value
+
+    def mean(name: str, scale: float = 1) -> float:
+        count = totals.get(name + "_count", 0)
+        return round(totals.get(name + "_sum", 0) / count * scale, 1) if count else 0.0
+
+    return {"requests": int(totals.get("ml_http_requests_total", 0)),
+            "errors": int(totals.get("errors", 0)),
+            "in_flight": int(totals.get("ml_http_requests_in_flight", 0)),
+            "mean_latency_ms": mean("ml_http_request_duration_seconds", 1000),
+            "tokens_per_second": mean("ml_generation_tokens_per_second"),
+            "mean_image_decode_ms": mean("ml_image_decode_seconds", 1000),
+            "models_mb": {model: round(memory.get(model, 0) / 1024 ** 2)
+                          for model, value in loaded.items() if value}}
 
 
 class MLModel():
     """Machine learning superclass starts server and activates chosen ml model
     Methods: __init__
             start
+            wait_until_ready
+            server_state
+            server_metrics
             run_server
-            st_stop_Server
+            stop_server
+            server_status
     """
     def __init__(self, modeltype: str = "",
-                 app: str = "http://localhost:8000") -> None:
+                 app: str = "http://localhost:8000",
+                 client: MLClient = None) -> None:
         """Initializes class
 
         Args:
@@ -27,21 +296,40 @@ class MLModel():
                                        Defaults to "".
             app (str, optional): Server on where the ml modelserver are located.
                                  Defaults to "http://localhost:8000".
+            client (MLClient, optional): http transport to use.
+                                         Defaults to the shared client.
         """
+        self.client = client or get_client()
         self.app = app
         self.modeltype = modeltype
         self.response = requests.Response
         self.text = str
-        self.serverprocess = subprocess.Popen
+        self.supervisor = Supervisor()
         self.out = {}
+        # typed result of the last single request, None if it failed
+        self.result = None
+
+    def start(self, timeout: float = 10):
+        """Activates the selected modeltype on the machine learning server,
+        nothing is sent if the server reports the model as loaded
 
-    def start(self):
-        """Activates the selected modeltype on the machine learning server
+        Args:
+            timeout (float, optional): Seconds to wait for a server the supervisor
+                                       is starting. Defaults to 10.
         """
         selected_model = {"name": self.modeltype}
         endpoint = self.app + "/start/"
+        state = self.server_state()
+        if state.get("models", {}).get(self.modeltype, {}).get("loaded"):
+            return self.modeltype
+        # only a server the supervisor runs is worth waiting for, a stopped
+        # server would hold up every rerun for the whole timeout
+        if not state and not (self.supervisor.status()["running"] and self.wait_until_ready(timeout)):
+            print("No connection to ml server")
+            return "Error"
         try:
-            self.response= requests.post(url=endpoint, json=selected_model)
+            self.response= self.client.post(url=endpoint, json=selected_model)
+            forget(("server_state", self.app))
             print(self.response.status_code, self.modeltype)
             if self.response.status_code == 200:
                 active_model = self.modeltype
@@ -53,26 +341,91 @@ class MLModel():
         return active_model
 
 
-    def run_server(self):
-        """Runs the Machine learning server provided by nordaxon"""
-        sub_args = [sys.executable, 'src/main.py']
-        self.serverprocess = subprocess.Popen(sub_args,
-                                  stdin=subprocess.PIPE,
-                                  stdout=subprocess.PIPE,
-                                  creationflags=subprocess.CREATE_NEW_CONSOLE,
-                                  shell=True)
+    def wait_until_ready(self, timeout: float = 60, interval: float = 0.5) -> bool:
+        """Polls /ready until the server is up and its preloaded and
+        warm-up models are loaded
 
-    def stop_server(self, process=""):
-        """Stops the machine learning server provided by nordaxon
+        Args:
+            timeout (float, optional): Seconds to wait. Defaults to 60.
+            interval (float, optional): Seconds between polls. Defaults to 0.5.
+
+        Returns:
+            bool: True if the server is ready
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                # plain requests, the shared client would retry a refused connection with backoff
+                if requests.get(self.app + "/ready", timeout=interval + 1).status_code == 200:
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            if time.time() >= deadline:
+                return False
+            time.sleep(interval)
+
+    def server_state(self, max_age: float = 2) -> dict:
+        """Reads /ready from the machine learning server, remembered for
+        max_age seconds
 
         Args:
-            process (str, optional): What process number to kill.
-                                     Defaults to "".
+            max_age (float, optional): seconds a state is reused. Defaults to 2.
+
+        Returns:
+            dict: ready, models and errors, empty without a server
         """
-        if process != "":
-            subprocess.Popen("TASKKILL /F /PID {pid} /T".format(pid=process))
-        else:
-            subprocess.Popen("TASKKILL /F /PID {pid} /T".format(pid=self.serverprocess.pid))
+        def read_state():
+            try:
+                # plain requests, the shared client would retry a refused connection with backoff
+                return requests.get(self.app + "/ready", timeout=2).json()
+            except (requests.exceptions.RequestException, ValueError):
+                return {}
+        return memoize(("server_state", self.app), max_age, read_state)
+
+    def server_metrics(self, max_age: float = 2) -> dict:
+        """Reads /metrics from the machine learning server and sums it up,
+        remembered for max_age seconds
+
+        Args:
+            max_age (float, optional): seconds a summary is reused. Defaults to 2.
+
+        Returns:
+            dict: summary from summarize_metrics, empty without a server
+        """
+        def read_metrics():
+            try:
+                # plain requests like server_state, the sidebar must not wait for retries
+                response = requests.get(self.app + "/metrics", timeout=2)
+                response.raise_for_status()
+            except requests.exceptions.RequestException:
+                return {}
+            return summarize_metrics(parse_metrics(response.text))
+        return memoize(("server_metrics", self.app), max_age, read_metrics)
+
+    def run_server(self) -> int:
+        """Starts the machine learning server provided by nordaxon under
+        the supervisor, which keeps running when the browser is closed
+
+        Returns:
+            int: process id of the supervisor, 0 if it did not start
+        """
+        return self.supervisor.start()
+
+    def stop_server(self) -> bool:
+        """Stops the machine learning server provided by nordaxon gracefully
+
+        Returns:
+            bool: True if the server is stopped
+        """
+        return self.supervisor.stop()
+
+    def server_status(self) -> dict:
+        """State of the supervised machine learning server
+
+        Returns:
+            dict: running, pid, server_pid, restarts and started
+        """
+        return self.supervisor.status()
 
 
 class MLTextGenerator(MLModel):
@@ -83,10 +436,11 @@ class MLTextGenerator(MLModel):
             st_stop_Server : from super class
 
             get_text_get
-            _clean_text_gen
+            stream_text_gen
     """
     def __init__(self, modeltype: str = "text_generator",
-                 app: str = "http://localhost:8000") -> None:
+                 app: str = "http://localhost:8000",
+                 client: MLClient = None) -> None:
         """Intitializes class
 
         Args:
@@ -94,8 +448,10 @@ class MLTextGenerator(MLModel):
                                        Defaults to "text_generator".
             app (str, optional): Machine learning server adress.
                                  Defaults to "http://localhost:8000".
+            client (MLClient, optional): http transport to use.
+                                         Defaults to the shared client.
         """
-        super().__init__(modeltype=modeltype, app=app)
+        super().__init__(modeltype=modeltype, app=app, client=client)
 
     def get_text_gen(self, text: str) -> dict:
         """Machine learning model generates text on provided string
@@ -113,23 +469,48 @@ class MLTextGenerator(MLModel):
                     "context": text,
                     "result": "ConnectionError"}
         try:
-            self.response= requests.post(url=endpoint, json=context)
-            self._clean_text_gen()
-            #self.out["result"] = self.response.text.split(":")[1][:-1]
-            self.out["result"] = self.response.text
-
-        except requests.exceptions.RequestException as error_type:
+            self.response= self.client.post(url=endpoint, json=context)
+            result = self.client.decode(self.response)
+            self.text = result["generated_text"]
+            self.out["result"] = json.dumps(result)
+        except (requests.exceptions.RequestException, ValueError) as error_type:
             print("No connection to ml server", error_type)
         return self.out
 
-    def _clean_text_gen(self):
+    def stream_text_gen(self, text: str):
+        """Machine learning model generates text on provided string and
+           sends it back token by token as server-sent events.
+           self.out holds the full result when the stream is done
 
-        """Cleans api result from linebreaks and double spaces
+        Args:
+            text (str): Start text for the machine learning model
+
+        Yields:
+            str: the next piece of generated text
         """
-        modify = self.response.text.strip()
-        newmodify = modify
-        print("garbage cleaner!!!!")
-        self.text = newmodify
+        endpoint = (self.app + "/text_generation/stream")
+        self.out = {"date": str(datetime.now()),
+                    "modeltype": self.modeltype,
+                    "context": text,
+                    "result": "ConnectionError"}
+        try:
+            with self.client.post(url=endpoint, json={"context": text}, stream=True) as self.response:
+                self.response.encoding = "utf-8"
+                event = ""
+                for line in self.response.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:"):
+                        data = json.loads(line[len("data:"):])
+                        if event == "done":
+                            self.out["result"] = json.dumps(data)
+                        elif event == "error":
+                            print("Text generation failed", data["detail"])
+                        else:
+                            yield data["token"]
+                        event = ""
+        except requests.exceptions.RequestException as error_type:
+            print("No connection to ml server", error_type)
 
 
 class MLSentimentAnalysis(MLModel):
@@ -140,9 +521,11 @@ class MLSentimentAnalysis(MLModel):
             st_stop_Server : from super class
 
             analyse_sentiment
+            analyse_sentiment_batch
     """
     def __init__(self, modeltype: str = "sentiment_analysis",
-                 app: str = "http://localhost:8000") -> None:
+                 app: str = "http://localhost:8000",
+                 client: MLClient = None) -> None:
         """Intitializes class
 
         Args:
@@ -150,9 +533,11 @@ class MLSentimentAnalysis(MLModel):
                                        Defaults to "text_generator".
             app (str, optional): Machine learning server adress.
                                  Defaults to "http://localhost:8000".
+            client (MLClient, optional): http transport to use.
+                                         Defaults to the shared client.
         """
         self.endpoint = (app + "/sentiment_analysis/")
-        super().__init__(modeltype=modeltype, app=app)
+        super().__init__(modeltype=modeltype, app=app, client=client)
 
     def analyse_sentiment(self, text: str) -> dict:
         """Machine learning model generates analyses sentiment on
@@ -170,17 +555,46 @@ class MLSentimentAnalysis(MLModel):
                     "modeltype": self.modeltype,
                     "context": text,
                     "result": "ConnectionError",
-                    "score": ""}
+                    "score": 0.0}
+        self.result = None
         try:
-            self.response= requests.post(url=endpoint, json=context)
-            result = dict(self.response.json())
-            self.out["result"] = result["sentiment_label"]
-            self.out["score"] = result["score"]
-        except requests.exceptions.RequestException as errortype:
+            self.response= self.client.post(url=endpoint, json=context)
+            result = self.client.decode(self.response)
+            self.result = Sentiment(result["sentiment_label"], result["score"])
+            self.out["result"], self.out["score"] = self.result
+        except (requests.exceptions.RequestException, ValueError) as errortype:
             print("No connection to ml server", errortype)
 
         return self.out
 
+    def analyse_sentiment_batch(self, texts: list, chunk_size: int = 256) -> list:
+        """Analyses the sentiment of many texts with one request per chunk
+
+        Args:
+            texts (list): Texts to analyse
+            chunk_size (int, optional): Texts sent per request. Defaults to 256.
+
+        Returns:
+            list: one output dictionary per text in the same order
+        """
+        endpoint = (self.app + "/sentiment_analysis/batch")
+        outs = []
+        for start in range(0, len(texts), chunk_size):
+            chunk = texts[start:start + chunk_size]
+            results = [Sentiment("ConnectionError", 0.0)] * len(chunk)
+            try:
+                self.response= self.client.post(url=endpoint, json={"texts": chunk})
+                results = [Sentiment(result["sentiment_label"], result["score"])
+                           for result in self.client.decode(self.response)]
+            except (requests.exceptions.RequestException, ValueError) as errortype:
+                print("No connection to ml server", errortype)
+            outs += [{"date": str(datetime.now()),
+                      "modeltype": self.modeltype,
+                      "context": text,
+                      "result": result.label,
+                      "score": result.score} for text, result in zip(chunk, results)]
+        return outs
+
 
 class MLImageClassifier(MLModel):
     """Machine learning model image classifier
@@ -191,9 +605,13 @@ class MLImageClassifier(MLModel):
 
             _change_classes
             classify_image
+            classify_image_batch
+            classify_embedding
+            text_embedding
     """
     def __init__(self, modeltype: str = "image_classifier",
-                 app: str = "http://localhost:8000") -> None:
+                 app: str = "http://localhost:8000",
+                 client: MLClient = None) -> None:
         """Intitializes class
 
         Args:
@@ -201,49 +619,164 @@ class MLImageClassifier(MLModel):
                                        Defaults to "text_generator"
             app (str, optional): Machine learning server adress.
                                  Defaults to "http://localhost:8000"
+            client (MLClient, optional): http transport to use.
+                                         Defaults to the shared client.
         """
         self.endpoint = (app + "/classify_image/")
-        super().__init__(modeltype=modeltype, app=app)
+        super().__init__(modeltype=modeltype, app=app, client=client)
 
-    def _change_classes(self, new_classes: dict):
-        """Changes the class used to try to match the picture to
+    def _change_classes(self, new_classes: list):
+        """Changes the default classes the server matches pictures to
 
         Args:
-            new_classes (dict): new classes in the format
-            {"class_1 : "", "class_2" : "", "class_3" : ""}
+            new_classes (list): new class labels, any number of labels
         """
-        requests.put(url=self.app + "/change_classes/",
-                     json=new_classes)
+        self.client.put(url=self.app + "/change_classes/",
+                        json={"labels": new_classes})
 
     def classify_image(self,
                        file: bytes,
-                       classes: dict = None,
+                       classes: list = None,
                        name: str = "") -> dict:
         """Classifies image to provided or default classes.
+           The classes are sent with the request so other users
+           of the server keep their own classes.
 
         Args:
             file (bytes): imagefile to classify
-            classes (dict, optional): Classes to compare to. Defaults to {}.
+            classes (list, optional): Classes to compare to. Defaults to None.
             name (str, optional): filename. Defaults to "".
 
         Returns:
-            dict: date, modeltype, result, image in a dictionary
+            dict: date, modeltype, result, image and embedding in a dictionary
         """
-        if classes is not None:
-            self._change_classes(classes)
         files = {'file': file}
+        data = {'labels': classes} if classes else None
+        self.out = {"date": str(datetime.now()),
+                    "filename": name,
+                    "modeltype": self.modeltype,
+                    "result": "ConnectionError",
+                    "image": file,
+                    "embedding": None}
+        self.result = None
+        try:
+            self.response= self.client.post(url=self.endpoint, files=files, data=data,
+                                            params={"embedding": "true"})
+            self.result = _classification(self.client.decode(self.response))
+            self.out["result"] = json.dumps(self.result.probabilities)
+            self.out["embedding"] = self.result.embedding
+        except (requests.exceptions.RequestException, ValueError) as errortype:
+            print("No connection to ml server", errortype)
+        return self.out
+
+    def classify_image_batch(self,
+                             images: list,
+                             classes: list = None,
+                             chunk_size: int = 16) -> list:
+        """Classifies many images with one request per chunk
+
+        Args:
+            images (list): (filename, imagefile bytes) tuples
+            classes (list, optional): Classes to compare to. Defaults to None.
+            chunk_size (int, optional): Images sent per request. Defaults to 16.
+
+        Returns:
+            list: one output dictionary per image in the same order,
+                  error is None or why the image was not classified
+        """
+        endpoint = (self.app + "/classify_image/batch")
+        data = {'labels': classes} if classes else None
+        outs = []
+        for start in range(0, len(images), chunk_size):
+            chunk = images[start:start + chunk_size]
+            files = [('files', (name, file)) for name, file in chunk]
+            results = ["ConnectionError"] * len(chunk)
+            try:
+                self.response= self.client.post(url=endpoint, files=files, data=data,
+                                                params={"embedding": "true"})
+                # a file the server could not classify has an error entry in its place
+                results = [_classification(result) if "probabilities" in result else result["detail"]
+                           for result in self.client.decode(self.response)]
+            except (requests.exceptions.RequestException, ValueError) as errortype:
+                print("No connection to ml server", errortype)
+            for (name, file), result in zip(chunk, results):
+                classified = isinstance(result, Classification)
+                outs.append({"date": str(datetime.now()),
+                             "filename": name,
+                             "modeltype": self.modeltype,
+                             "result": json.dumps(result.probabilities) if classified else result,
+                             "error": None if classified else result,
+                             "image": file,
+                             "embedding": result.embedding if classified else None})
+        return outs
+
+    def classify_embedding(self,
+                           embedding: bytes,
+                           classes: list = None,
+                           name: str = "",
+                           image_sha256: str = "") -> dict:
+        """Classifies a stored image embedding to provided or default classes,
+           the server does not run the vision model and no image is sent
+
+        Args:
+            embedding (bytes): float16 embedding stored with an earlier result
+            classes (list, optional): Classes to compare to. Defaults to None.
+            name (str, optional): filename. Defaults to "".
+            image_sha256 (str, optional): content hash of the stored image. Defaults to "".
+
+        Returns:
+            dict: date, modeltype, result, image_sha256 and embedding in a dictionary
+        """
         self.out = {"date": str(datetime.now()),
                     "filename": name,
                     "modeltype": self.modeltype,
                     "result": "ConnectionError",
-                    "image": file}
+                    "image": None,
+                    "image_sha256": image_sha256,
+                    "embedding": embedding}
+        self.result = None
         try:
-            self.response= requests.post(url=self.endpoint, files=files)
-            self.out["result"] = self.response.text
-        except requests.exceptions.RequestException as errortype:
+            self.response= self.client.post(url=self.app + "/classify_embedding/",
+                                            json={"embedding": base64.b64encode(embedding).decode("ascii"),
+                                                  "labels": classes or []})
+            self.result = Classification(self.client.decode(self.response), embedding)
+            self.out["result"] = json.dumps(self.result.probabilities)
+        except (requests.exceptions.RequestException, ValueError) as errortype:
             print("No connection to ml server", errortype)
         return self.out
 
+    def text_embedding(self, text: str) -> bytes:
+        """Embeds a description to search the stored images with
+
+        Args:
+            text (str): description of an image
+
+        Returns:
+            bytes: float16 embedding like the stored ones, None if it failed
+        """
+        try:
+            response = self.client.post(url=self.app + "/text_embedding/", json={"context": text})
+            return base64.b64decode(self.client.decode(response)["embedding"], validate=True)
+        except (requests.exceptions.RequestException, ValueError, KeyError, binascii.Error) as errortype:
+            print("No connection to ml server", errortype)
+        return None
+
+
+def _classification(body: dict) -> Classification:
+    """Reads a classify_image response made with embedding=true
+
+    Args:
+        body (dict): decoded response
+
+    Returns:
+        Classification: probabilities and the embedding bytes or None
+    """
+    try:
+        embedding = base64.b64decode(body.get("embedding") or "", validate=True) or None
+    except (binascii.Error, ValueError):
+        embedding = None
+    return Classification(body["probabilities"], embedding)
+
 
 class MLQA(MLModel):
     """Machine learning model question answering
@@ -253,9 +786,12 @@ class MLQA(MLModel):
             st_stop_Server : from super class
 
             question_answering
+            question_answering_batch
+            question_answering_multi
     """
     def __init__(self, modeltype: str = "question_answering",
-                 app: str = "http://localhost:8000") -> None:
+                 app: str = "http://localhost:8000",
+                 client: MLClient = None) -> None:
         """Intitializes class
 
         Args:
@@ -263,9 +799,11 @@ class MLQA(MLModel):
                                        Defaults to "text_generator".
             app (str, optional): Machine learning server adress.
                                  Defaults to "http://localhost:8000".
+            client (MLClient, optional): http transport to use.
+                                         Defaults to the shared client.
         """
         self.endpoint = (app + "/question_answering/")
-        super().__init__(modeltype=modeltype, app=app)
+        super().__init__(modeltype=modeltype, app=app, client=client)
 
     def question_answering(self, question: str, context: str) -> dict:
         """Machine learning model generates answeres on provided text
@@ -289,183 +827,752 @@ class MLQA(MLModel):
                     "modeltype": self.modeltype,
                     "context": context,
                     "result": "ConnectionError",
-                    "score": "",
+                    "score": 0.0,
                     "question": question}
+        self.result = None
         try:
-            self.response= requests.post(url=endpoint, json=context_question)
-            self.out["result"] = self.response.text.split(":")[1][:-8]
-            self.out["score"] = self.response.text.split(":")[-1][:-1]
-        except requests.exceptions.RequestException as errortype:
+            self.response= self.client.post(url=endpoint, json=context_question)
+            self.result = Answer(**self.client.decode(self.response))
+            self.out["result"], self.out["score"] = self.result
+        except (requests.exceptions.RequestException, ValueError, TypeError) as errortype:
             print("No connection to ml server", errortype)
         return self.out
 
+    def question_answering_batch(self,
+                                 questions: list,
+                                 contexts: list,
+                                 chunk_size: int = 64) -> list:
+        """Answers many questions with one request per chunk
 
-def _text_generator_to_db(cursor: sqlite3.Cursor,
-                          database_connection: sqlite3.Connection,
-                          user_input: dict):
-    text_generator_table_create_command = """CREATE TABLE IF NOT EXISTS text_generator(
-                                             id INTEGER PRIMARY KEY,
-                                             date TEXT NOT NULL,
-                                             context TEXT NOT NULL,
-                                             result TEXT NOT NULL)"""
-    text_generator_insert_query = """INSERT INTO text_generator
-                                    (date, context, result) VALUES (?, ?, ?)"""
-
-    cursor.execute(text_generator_table_create_command)
-    # text_generator data tuple values [date, context, result]
-    data_tuple = (user_input["date"], user_input["context"], user_input["result"])
-    cursor.execute(text_generator_insert_query, data_tuple)
-    database_connection.commit()
-    cursor.close()
-
-
-def _image_classifier_to_db(cursor: sqlite3.Cursor,
-                            database_connection: sqlite3.Connection,
-                            user_input: dict):
-    image_classifier_table_create_command = """CREATE TABLE IF NOT EXISTS image_classifier(
-                                               id INTEGER PRIMARY KEY,
-                                               date TEXT NOT NULL,
-                                               filename TEXT NOT NULL,
-                                               result TEXT NOT NULL,
-                                               image BLOB NOT NULL)"""
-    image_classifier_insert_query = """INSERT INTO image_classifier
-                                    (date, filename, result, image) VALUES (?, ?, ?, ?)"""
-    cursor.execute(image_classifier_table_create_command)
-    # image_classifier data tuple values
-    # [date, filename, result, image]
-    data_tuple = (user_input["date"],
-                  user_input["filename"],
-                  user_input["result"],
-                  user_input["image"])
-    cursor.execute(image_classifier_insert_query, data_tuple)
-    database_connection.commit()
-    cursor.close()
-
-
-def _sentiment_analysis_to_db(cursor: sqlite3.Cursor,
-                              database_connection: sqlite3.Connection,
-                              user_input: dict):
-    sentiment_analysis_table_create_command = """CREATE TABLE IF NOT EXISTS sentiment_analysis(
-                                                 id INTEGER PRIMARY KEY,
-                                                 date TEXT NOT NULL,
-                                                 context TEXT NOT NULL,
-                                                 result TEXT NOT NULL,
-                                                 score TEXT NOT NULL)"""
-    sentiment_analysis_insert_query = """INSERT INTO sentiment_analysis
-                                    (date, context, result, score) VALUES (?, ?, ?, ?)"""
-    cursor.execute(sentiment_analysis_table_create_command)
-    # sentiment_analysis data tuple values
-    # [date, context, result, score]
-    data_tuple = (user_input["date"],
-                  user_input["context"],
-                  user_input["result"],
-                  user_input["score"])
-    cursor.execute(sentiment_analysis_insert_query, data_tuple)
-    database_connection.commit()
-    cursor.close()
-
-
-def _question_answering_to_db(cursor: sqlite3.Cursor,
-                              database_connection: sqlite3.Connection,
-                              user_input: dict):
-
-    question_answering_table_create_command = """CREATE TABLE IF NOT EXISTS question_answering(
-                                                 id INTEGER PRIMARY KEY,
-                                                 date TEXT NOT NULL,
-                                                 context TEXT NOT NULL,
-                                                 result TEXT NOT NULL,
-                                                 score TEXT NOT NULL,
-                                                 question TEXT NOT NULL)"""
-    question_answering_insert_query = """INSERT INTO question_answering
-                                      (date,
-                                       context,
-                                       result,
-                                       score,
-                                       question) VALUES (?, ?, ?, ?, ?)"""
-
-    cursor.execute(question_answering_table_create_command)
-    # question_answering data tuple values
-    # [date, context, result, score, question]
-    data_tuple = (user_input["date"],
-                  user_input["context"],
-                  user_input["result"],
-                  user_input["score"],
-                  user_input["question"])
-    cursor.execute(question_answering_insert_query, data_tuple)
-    database_connection.commit()
-    cursor.close()
+        Args:
+            questions (list): Questions to find answers on
+            contexts (list): Source to find the answer on for each question
+            chunk_size (int, optional): Questions sent per request. Defaults to 64.
 
+        Returns:
+            list: one output dictionary per question in the same order
+        """
+        endpoint = (self.app + "/qa/batch")
+        pairs = list(zip(questions, contexts))
+        outs = []
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            items = [{"context": context, "question": question} for question, context in chunk]
+            results = [Answer("ConnectionError", 0.0)] * len(chunk)
+            try:
+                self.response= self.client.post(url=endpoint, json={"items": items})
+                results = [Answer(**result) for result in self.client.decode(self.response)]
+            except (requests.exceptions.RequestException, ValueError, TypeError) as errortype:
+                print("No connection to ml server", errortype)
+            outs += [{"date": str(datetime.now()),
+                      "modeltype": self.modeltype,
+                      "context": context,
+                      "result": result.answer,
+                      "score": result.score,
+                      "question": question} for (question, context), result in zip(chunk, results)]
+        return outs
+
+    def question_answering_multi(self, context: str, questions: list) -> list:
+        """Answers many questions about one context in one request,
+           the server tokenizes the context once for all questions
 
-def write_to_db(user_input: dict):
-    """Writes information to the sql database
+        Args:
+            context (str): Source to find the answers on
+            questions (list): Questions to find answers on
+
+        Returns:
+            list: one output dictionary per question in the same order
+        """
+        endpoint = (self.app + "/qa/multi")
+        results = [Answer("ConnectionError", 0.0)] * len(questions)
+        try:
+            self.response= self.client.post(url=endpoint, json={"context": context, "questions": questions})
+            results = [Answer(**result) for result in self.client.decode(self.response)]
+        except (requests.exceptions.RequestException, ValueError, TypeError) as errortype:
+            print("No connection to ml server", errortype)
+        return [{"date": str(datetime.now()),
+                 "modeltype": self.modeltype,
+                 "context": context,
+                 "result": result.answer,
+                 "score": result.score,
+                 "question": question} for question, result in zip(questions, results)]
+
+
+_TABLES = {
+    "text_generator": ("""CREATE TABLE IF NOT EXISTS text_generator(
+                          id INTEGER PRIMARY KEY,
+                          date TEXT NOT NULL,
+                          context TEXT NOT NULL,
+                          result TEXT NOT NULL)""",
+                       """INSERT INTO text_generator
+                          (date, context, result) VALUES (?, ?, ?)""",
+                       ("date", "context", "result")),
+    "image_classifier": ("""CREATE TABLE IF NOT EXISTS image_classifier(
+                            id INTEGER PRIMARY KEY,
+                            date TEXT NOT NULL,
+                            filename TEXT NOT NULL,
+                            result TEXT NOT NULL,
+                            image_sha256 TEXT NOT NULL REFERENCES images(sha256),
+                            embedding BLOB)""",
+                         """INSERT INTO image_classifier
+                            (date, filename, result, image_sha256, embedding) VALUES (?, ?, ?, ?, ?)""",
+                         ("date", "filename", "result", "image_sha256", "embedding")),
+    "sentiment_analysis": ("""CREATE TABLE IF NOT EXISTS sentiment_analysis(
+                              id INTEGER PRIMARY KEY,
+                              date TEXT NOT NULL,
+                              context TEXT NOT NULL,
+                              result TEXT NOT NULL,
+                              score REAL NOT NULL)""",
+                           """INSERT INTO sentiment_analysis
+                              (date, context, result, score) VALUES (?, ?, ?, ?)""",
+                           ("date", "context", "result", "score")),
+    "question_answering": ("""CREATE TABLE IF NOT EXISTS question_answering(
+                              id INTEGER PRIMARY KEY,
+                              date TEXT NOT NULL,
+                              context TEXT NOT NULL,
+                              result TEXT NOT NULL,
+                              score REAL NOT NULL,
+                              question TEXT NOT NULL)""",
+                           """INSERT INTO question_answering
+                              (date, context, result, score, question) VALUES (?, ?, ?, ?, ?)""",
+                           ("date", "context", "result", "score", "question")),
+}
+
+# images are stored once per content hash and referenced from image_classifier
+_IMAGES_TABLE_CREATE_COMMAND = """CREATE TABLE IF NOT EXISTS images(
+                                  sha256 TEXT PRIMARY KEY,
+                                  image BLOB NOT NULL,
+                                  thumbnail BLOB NOT NULL)"""
+
+# columns shown in history listings, image data is never listed
+_HISTORY_COLUMNS = {
+    "text_generator": ("id", "date", "context", "result"),
+    "image_classifier": ("id", "date", "filename", "result", "image_sha256"),
+    "sentiment_analysis": ("id", "date", "context", "result", "score"),
+    "question_answering": ("id", "date", "question", "context", "result", "score"),
+}
+
+def make_thumbnail(image: bytes, size: int = 128) -> bytes:
+    """Makes a small jpeg of an image for the UI
 
     Args:
-        user_input (dict): Output from the machine learning classes
+        image (bytes): imagefile
+        size (int, optional): max width and height. Defaults to 128.
+
+    Returns:
+        bytes: jpeg thumbnail, empty if the file is not an image
     """
     try:
-        default_db_name = "main_database.db"
-        print(user_input['modeltype'])
+        thumbnail = ImageOps.exif_transpose(Image.open(BytesIO(image)))
+        thumbnail.thumbnail((size, size))
+        output = BytesIO()
+        thumbnail.convert("RGB").save(output, format="JPEG", quality=80)
+        return output.getvalue()
+    except (OSError, ValueError) as error:
+        print("Could not make thumbnail", error)
+        return b""
+
+
+# markers put on the write queue
+_FLUSH = object()
+_STOP = object()
 
-        database_connection = sqlite3.connect(default_db_name)
-        cursor = database_connection.cursor()
-        print("Connected to SQLite")
 
-        if user_input['modeltype'] == "text_generator":
-            _text_generator_to_db(cursor, database_connection, user_input)
+class DatabaseEngine():
+    """Keeps one SQLite connection open and writes results behind
+    the caller in batched transactions
+    Methods: __init__
+            write
+            write_batch
+            version
+            flush
+            query
+            get_image
+            get_thumbnail
+            close
+    """
+    def __init__(self,
+                 db_name: str = "main_database.db",
+                 flush_interval: float = 0.5,
+                 max_batch: int = 500) -> None:
+        """Initializes class, opens the connection and creates the tables
 
-        elif user_input['modeltype'] == "sentiment_analysis":
-            _sentiment_analysis_to_db(cursor, database_connection, user_input)
+        Args:
+            db_name (str, optional): sqlite database file.
+                                     Defaults to "main_database.db".
+            flush_interval (float, optional): seconds a queued row waits for
+                                              more rows. Defaults to 0.5.
+            max_batch (int, optional): max rows in one transaction.
+                                       Defaults to 500.
+        """
+        self.db_name = db_name
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.connection = sqlite3.connect(db_name, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("PRAGMA cache_size=-16000")
+            self.connection.execute(_IMAGES_TABLE_CREATE_COMMAND)
+            for table, (create_command, _, _) in _TABLES.items():
+                self.connection.execute(create_command)
+            self._inserts = {table: insert_query for table, (_, insert_query, _) in _TABLES.items()}
+            self._migrate_embedding_column()
+            if self._migrate_image_column():
+                # old tables keep their NOT NULL image column, it is left empty
+                self._inserts["image_classifier"] = """INSERT INTO image_classifier
+                    (date, filename, result, image_sha256, embedding, image)
+                    VALUES (?, ?, ?, ?, ?, zeroblob(0))"""
+            self._migrate_results()
+            for table in _TABLES:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_date ON {table}(date)")
+            self.connection.commit()
+        # stamp of the last write per table, cached history is keyed on it
+        self._write_stamps = itertools.count(1)
+        self._versions = {table: 0 for table in _TABLES}
+        # a failed write behind the caller, raised by the next flush
+        self._error = None
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_behind, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def write(self, user_input: dict):
+        """Queues a result for the next batched transaction
 
-        elif user_input['modeltype'] == "image_classifier":
-            _image_classifier_to_db(cursor, database_connection, user_input)
+        Args:
+            user_input (dict): Output from the machine learning classes
+        """
+        user_input = self._prepare(user_input)
+        if user_input is None:
+            return
+        self._queue.put(user_input)
+        self._versions[user_input['modeltype']] = next(self._write_stamps)
 
-        elif user_input['modeltype'] == "question_answering":
-            _question_answering_to_db(cursor, database_connection, user_input)
+    def write_batch(self, user_inputs: list, statements: list = ()):
+        """Writes results and extra statements in one transaction now,
+        after the queued results
 
-        else:
+        Args:
+            user_inputs (list): Outputs from the machine learning classes
+            statements (list, optional): (sql, parameters) tuples committed
+                                         together with the results. Defaults to ().
+
+        Raises:
+            sqlite3.Error: if the transaction failed, nothing of it is written
+        """
+        user_inputs = [prepared for prepared in map(self._prepare, user_inputs) if prepared is not None]
+        self.flush()
+        self._insert(user_inputs, statements)
+        for user_input in user_inputs:
+            self._versions[user_input['modeltype']] = next(self._write_stamps)
+
+    def version(self, table: str) -> tuple:
+        """Changes whenever a result is written to the table, by this app
+        or by another connection to the database file
+
+        Args:
+            table (str): model table
+
+        Returns:
+            tuple: last write stamp of the table and the sqlite data_version
+        """
+        with self.lock:
+            data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        return self._versions[table], data_version
+
+    def flush(self):
+        """Writes all queued results now and waits until they are committed
+
+        Raises:
+            sqlite3.Error: if a queued result could not be written since the last flush
+        """
+        self._drain()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def query(self, sql: str, parameters: tuple = ()) -> list:
+        """Runs a read query after the queued results are written
+
+        Args:
+            sql (str): query to run
+            parameters (tuple, optional): query parameters. Defaults to ().
+
+        Returns:
+            list: fetched rows
+        """
+        self._drain()
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def get_image(self, image_sha256: str) -> bytes:
+        """Reads a full image from the image store
+
+        Args:
+            image_sha256 (str): content hash of the image
+
+        Returns:
+            bytes: imagefile or None if not stored
+        """
+        rows = self.query("SELECT image FROM images WHERE sha256 = ?", (image_sha256,))
+        return rows[0][0] if rows else None
+
+    def get_thumbnail(self, image_sha256: str) -> bytes:
+        """Reads the thumbnail of an image from the image store
+
+        Args:
+            image_sha256 (str): content hash of the image
+
+        Returns:
+            bytes: jpeg thumbnail or None if not stored
+        """
+        rows = self.query("SELECT thumbnail FROM images WHERE sha256 = ?", (image_sha256,))
+        return rows[0][0] if rows else None
+
+    def close(self):
+        "Writes the queued results and closes the connection"
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        with self.lock:
+            self.connection.close()
+
+    def _prepare(self, user_input: dict) -> dict:
+        "Checks the model type and adds the content hash of an image, None if the result can not be stored"
+        if user_input['modeltype'] not in _TABLES:
             print("Error! Not a valid model type.")
+            return None
+        if user_input['modeltype'] == "image_classifier" and not user_input.get("image_sha256"):
+            user_input = dict(user_input,
+                              image_sha256=hashlib.sha256(user_input["image"]).hexdigest())
+        return user_input
+
+    def _drain(self):
+        "Waits until the queued results are written"
+        if self._writer.is_alive():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def _write_behind(self):
+        "Collects queued results and inserts them in one transaction per batch"
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch and batch[-1] not in (_FLUSH, _STOP):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            running = _STOP not in batch
+            try:
+                self._insert([user_input for user_input in batch if user_input not in (_FLUSH, _STOP)])
+            except sqlite3.Error as error:
+                print("Failed to insert data into SQLite database", error)
+                self._error = error
+            for _ in batch:
+                self._queue.task_done()
+
+    def _store_image(self, image_sha256: str, image: bytes):
+        "Stores an image and its thumbnail unless the same content is stored"
+        exists = self.connection.execute("SELECT 1 FROM images WHERE sha256 = ?",
+                                         (image_sha256,)).fetchone()
+        if exists is None:
+            self.connection.execute("INSERT INTO images (sha256, image, thumbnail) VALUES (?, ?, ?)",
+                                    (image_sha256, image, make_thumbnail(image)))
+
+    def _migrate_embedding_column(self):
+        "Adds the embedding column to an image_classifier table from before embeddings were stored"
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(image_classifier)")]
+        if "embedding" not in columns:
+            self.connection.execute("ALTER TABLE image_classifier ADD COLUMN embedding BLOB")
+
+    def _migrate_image_column(self) -> bool:
+        """Moves the images of an image_classifier table from before the
+        image store into the store
 
-    except sqlite3.Error as error:
-        print("Failed to insert data into SQLite database", error)
-    except UnboundLocalError as error:
-        print("Database not created yes", error)
+        Returns:
+            bool: True if the table has the old image column
+        """
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(image_classifier)")]
+        if "image" not in columns:
+            return False
+        if "image_sha256" not in columns:
+            self.connection.execute("ALTER TABLE image_classifier ADD COLUMN image_sha256 TEXT")
+        rowids = self.connection.execute("""SELECT id FROM image_classifier
+                                            WHERE image_sha256 IS NULL""").fetchall()
+        for (rowid,) in rowids:
+            image = self.connection.execute("SELECT image FROM image_classifier WHERE id = ?",
+                                            (rowid,)).fetchone()[0]
+            image_sha256 = hashlib.sha256(image).hexdigest()
+            self._store_image(image_sha256, image)
+            self.connection.execute("""UPDATE image_classifier SET image_sha256 = ?, image = zeroblob(0)
+                                       WHERE id = ?""", (image_sha256, rowid))
+        return True
+
+    def _migrate_results(self):
+        """Converts results stored before the typed responses, once per database file:
+        scores become numbers, answers lose their quotes and image results become
+        JSON with numeric probabilities"""
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] >= 1:
+            return
+        for table in ("sentiment_analysis", "question_answering"):
+            columns = {row[1]: row[2] for row in self.connection.execute(f"PRAGMA table_info({table})")}
+            if columns.get("score", "REAL") == "REAL":
+                continue
+            # sqlite can not change a column type, the table is copied
+            create_command, _, table_columns = _TABLES[table]
+            self.connection.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+            self.connection.execute(create_command)
+            selected = ", ".join("CAST(score AS REAL)" if column == "score" else column
+                                 for column in table_columns)
+            self.connection.execute(f"""INSERT INTO {table} (id, {', '.join(table_columns)})
+                                        SELECT id, {selected} FROM {table}_old""")
+            self.connection.execute(f"DROP TABLE {table}_old")
+        answers = self.connection.execute("""SELECT id, result FROM question_answering
+                                             WHERE result LIKE '"%"'""").fetchall()
+        for rowid, answer in answers:
+            try:
+                answer = json.loads(answer)
+            except ValueError:
+                answer = answer[1:-1]
+            self.connection.execute("UPDATE question_answering SET result = ? WHERE id = ?", (answer, rowid))
+        results = self.connection.execute("SELECT id, result FROM image_classifier").fetchall()
+        for rowid, result in results:
+            try:
+                probabilities = json.loads(result)
+            except ValueError:
+                try:
+                    probabilities = ast.literal_eval(result)
+                except (ValueError, SyntaxError):
+                    continue
+            if isinstance(probabilities, dict):
+                try:
+                    converted = json.dumps({label: float(value) for label, value in probabilities.items()})
+                except (TypeError, ValueError):
+                    continue
+                if converted != result:
+                    self.connection.execute("UPDATE image_classifier SET result = ? WHERE id = ?",
+                                            (converted, rowid))
+        self.connection.execute("PRAGMA user_version = 1")
+
+    def _insert(self, batch: list, statements: list = ()):
+        "Inserts the results grouped per table and runs the statements in one transaction"
+        rows = {}
+        images = {}
+        for user_input in batch:
+            _, _, columns = _TABLES[user_input['modeltype']]
+            rows.setdefault(user_input['modeltype'], []).append(
+                tuple(user_input.get(column) for column in columns))
+            # a result classified from a stored embedding refers to an image that is stored
+            if user_input['modeltype'] == "image_classifier" and user_input.get("image") is not None:
+                images[user_input["image_sha256"]] = user_input["image"]
+        with self.lock, self.connection:
+            for image_sha256, image in images.items():
+                self._store_image(image_sha256, image)
+            for table, table_rows in rows.items():
+                self.connection.executemany(self._inserts[table], table_rows)
+            for sql, parameters in statements:
+                self.connection.execute(sql, parameters)
+
+
+_shared_engine = None
+
+
+def get_engine() -> DatabaseEngine:
+    """Returns the DatabaseEngine shared by the app
 
-    finally:
-        if database_connection:
-            database_connection.close()
-            print("SQLite connection is closed")
+    Returns:
+        DatabaseEngine: the shared engine
+    """
+    global _shared_engine
+    with _shared_lock:
+        if _shared_engine is None:
+            _shared_engine = DatabaseEngine()
+    return _shared_engine
 
 
-def view_db_log(model: str):
-    """Creates view of current model table from the sql database
+def write_to_db(user_input: dict):
+    """Writes information to the sql database
 
     Args:
-        model (str): chosses model to view
+        user_input (dict): Output from the machine learning classes
     """
-    try:
-        default_db_name = "main_database.db"
-        database = sqlite3.connect(default_db_name)
+    get_engine().write(user_input)
 
-        if model == "text_generator":
-            df_database = pd.read_sql("SELECT * FROM text_generator", database)
 
-        elif model == "sentiment_analysis":
-            df_database = pd.read_sql("SELECT * FROM sentiment_analysis", database)
+def decode_embedding(embedding: bytes) -> np.ndarray:
+    """Unpacks a stored image embedding, little endian float16 values
 
-        elif model == "image_classifier":
-            df_database = pd.read_sql("SELECT * FROM image_classifier", database)
+    Args:
+        embedding (bytes): embedding column of image_classifier
 
-        elif model == "question_answering" :
-            df_database = pd.read_sql("SELECT * FROM question_answering", database)
-        else:
-            print("Error! Not a valid model type.")
-        st.write(df_database)
-    except pd.io.sql.DatabaseError as error:
-        print("Database was not found!", error)
-    except UnboundLocalError as error:
-        print("Database not created yes", error)
-    finally:
-        database.close()
+    Returns:
+        np.ndarray: float32 embedding vector
+    """
+    return np.frombuffer(embedding, dtype="<f2").astype(np.float32)
+
+
+class EmbeddingIndex():
+    """Nearest neighbour search over the stored image embeddings,
+    one entry per stored image. Small indexes are scanned exactly,
+    large ones are split in clusters and only the clusters closest
+    to the query are scanned.
+    Methods: __init__
+            refresh
+            search
+            stats
+    """
+    def __init__(self,
+                 engine: DatabaseEngine = None,
+                 approximate_from: int = 20000,
+                 probes: int = 8) -> None:
+        """Initializes class, the embeddings are read at the first search
+
+        Args:
+            engine (DatabaseEngine, optional): database to index. Defaults to the shared engine.
+            approximate_from (int, optional): images from which the clustered search is used.
+                                              Defaults to 20000.
+            probes (int, optional): clusters scanned per query. Defaults to 8.
+        """
+        self.engine = engine or get_engine()
+        self.approximate_from = approximate_from
+        self.probes = probes
+        self.lock = threading.Lock()
+        self._version = None
+        self._last_id = 0
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._size = 0
+        self._rows = []
+        self._positions = {}
+        self._centroids = None
+        self._clusters = np.zeros(0, dtype=np.int32)
+        self._trained_size = 0
+
+    def refresh(self):
+        "Adds the rows written since the last refresh"
+        version = self.engine.version("image_classifier")
+        if version == self._version:
+            return
+        rows = self.engine.query("""SELECT id, image_sha256, filename, embedding FROM image_classifier
+                                    WHERE id > ? AND embedding IS NOT NULL ORDER BY id""",
+                                 (self._last_id,))
+        for rowid, image_sha256, filename, embedding in rows:
+            self._last_id = rowid
+            vector = decode_embedding(embedding)
+            if self._size and len(vector) != self._vectors.shape[1]:
+                continue
+            norm = np.linalg.norm(vector)
+            if not norm:
+                continue
+            if image_sha256 in self._positions:
+                # the newest row of an image is shown, the embedding is the same
+                self._rows[self._positions[image_sha256]] = (rowid, image_sha256, filename)
+                continue
+            self._append(vector / norm)
+            self._positions[image_sha256] = len(self._rows)
+            self._rows.append((rowid, image_sha256, filename))
+        if self._size >= self.approximate_from and self._size >= 2 * self._trained_size:
+            self._train()
+        self._version = version
+
+    def _append(self, vector: np.ndarray):
+        "Appends a normalized vector, the matrix grows by doubling"
+        if self._size == len(self._vectors):
+            grown = np.zeros((max(64, 2 * self._size), len(vector)), dtype=np.float32)
+            if self._size:
+                grown[:self._size] = self._vectors[:self._size]
+            self._vectors = grown
+            clusters = np.zeros(len(grown), dtype=np.int32)
+            clusters[:self._size] = self._clusters[:self._size]
+            self._clusters = clusters
+        self._vectors[self._size] = vector
+        if self._centroids is not None:
+            self._clusters[self._size] = np.argmax(self._centroids @ vector)
+        self._size += 1
+
+    def _train(self, iterations: int = 10, sample_size: int = 50000):
+        "Clusters the vectors with spherical k-means, retrained when the index doubles"
+        vectors = self._vectors[:self._size]
+        count = int(np.sqrt(self._size))
+        generator = np.random.default_rng(0)
+        sample = vectors[generator.choice(self._size, min(self._size, sample_size), replace=False)]
+        centroids = sample[generator.choice(len(sample), count, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(count):
+                members = sample[assignments == cluster]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[cluster] = centroid / np.linalg.norm(centroid)
+        self._centroids = centroids
+        for start in range(0, self._size, 8192):
+            end = min(start + 8192, self._size)
+            self._clusters[start:end] = np.argmax(vectors[start:end] @ centroids.T, axis=1)
+        self._trained_size = self._size
+
+    def search(self, embedding: np.ndarray, k: int = 5, exclude: str = None) -> list:
+        """Finds the stored images closest to an image or text embedding
+
+        Args:
+            embedding (np.ndarray): query embedding, from an image or from /text_embedding/
+            k (int, optional): images to return. Defaults to 5.
+            exclude (str, optional): image_sha256 to leave out, e.g. the query image.
+                                     Defaults to None.
+
+        Returns:
+            list: id, image_sha256, filename and cosine similarity of the best matches
+        """
+        with self.lock:
+            self.refresh()
+            if not self._size or len(embedding) != self._vectors.shape[1]:
+                return []
+            query = np.asarray(embedding, dtype=np.float32)
+            query = query / (np.linalg.norm(query) or 1)
+            candidates = np.arange(self._size)
+            if self._centroids is not None:
+                closest = np.argsort(self._centroids @ query)[-self.probes:]
+                candidates = np.flatnonzero(np.isin(self._clusters[:self._size], closest))
+            scores = self._vectors[candidates] @ query
+            wanted = min(len(scores), k + 1)
+            best = np.argpartition(-scores, wanted - 1)[:wanted] if wanted else []
+            matches = []
+            for position in sorted(best, key=lambda position: -scores[position]):
+                rowid, image_sha256, filename = self._rows[candidates[position]]
+                if image_sha256 != exclude:
+                    matches.append({"id": rowid,
+                                    "image_sha256": image_sha256,
+                                    "filename": filename,
+                                    "score": float(scores[position])})
+            return matches[:k]
+
+    def stats(self) -> dict:
+        """Size of the index and the search it uses
+
+        Returns:
+            dict: images, clusters and approximate
+        """
+        return {"images": self._size,
+                "clusters": 0 if self._centroids is None else len(self._centroids),
+                "approximate": self._centroids is not None}
+
+
+_shared_index = None
+
+
+def get_index() -> EmbeddingIndex:
+    """Returns the EmbeddingIndex shared by the app
+
+    Returns:
+        EmbeddingIndex: the shared index
+    """
+    global _shared_index
+    engine = get_engine()
+    with _shared_lock:
+        if _shared_index is None:
+            _shared_index = EmbeddingIndex(engine)
+    return _shared_index
+
+
+def query_history(model: str,
+                  columns: tuple = None,
+                  limit: int = 20,
+                  before_id: int = None,
+                  date_from: date = None,
+                  date_to: date = None) -> pd.DataFrame:
+    """Gets one page of a model table, newest first, without image data
+
+    Args:
+        model (str): what table to access
+        columns (tuple, optional): columns to fetch, id is always included.
+                                   Defaults to all listing columns.
+        limit (int, optional): rows in the page. Defaults to 20.
+        before_id (int, optional): only rows with a lower id, the last id of
+                                   the previous page. Defaults to None.
+        date_from (date, optional): first day to include. Defaults to None.
+        date_to (date, optional): last day to include. Defaults to None.
+
+    Returns:
+        pd.DataFrame: the rows of the page
+    """
+    listing_columns = _HISTORY_COLUMNS[model]
+    columns = tuple(columns or listing_columns)
+    if any(column not in listing_columns for column in columns):
+        raise ValueError(f"History of {model} can only list {listing_columns}")
+    if "id" not in columns:
+        columns = ("id",) + columns
+    conditions = []
+    parameters = []
+    if before_id is not None:
+        conditions.append("id < ?")
+        parameters.append(before_id)
+    # dates are stored as text "YYYY-MM-DD HH:MM:SS" so they compare in order
+    if date_from is not None:
+        conditions.append("date >= ?")
+        parameters.append(str(date_from))
+    if date_to is not None:
+        conditions.append("date < ?")
+        parameters.append(str(date_to + timedelta(days=1)))
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    rows = get_engine().query(f"SELECT {', '.join(columns)} FROM {model}{where} "
+                              "ORDER BY id DESC LIMIT ?",
+                              tuple(parameters) + (limit,))
+    return pd.DataFrame(rows, columns=columns)
+
+
+@st.cache(allow_output_mutation=True, max_entries=64, show_spinner=False)
+def _cached_history(model: str, limit: int, before_id: int, date_from: date, date_to: date,
+                    version: tuple) -> pd.DataFrame:
+    "query_history remembered until version, the table version, changes"
+    return query_history(model, limit=limit, before_id=before_id, date_from=date_from, date_to=date_to)
+
+
+def view_db_log(model: str, page_size: int = 20):
+    """Creates a paginated view of current model table from the sql database
+
+    Args:
+        model (str): chosses model to view
+        page_size (int, optional): rows per page. Defaults to 20.
+    """
+    if model not in _TABLES:
+        print("Error! Not a valid model type.")
+        return
+    date_from = date_to = None
+    if st.checkbox("Filter by date", key=f"{model}_filter_dates"):
+        col_from, col_to = st.columns(2)
+        with col_from:
+            date_from = st.date_input("From", key=f"{model}_date_from")
+        with col_to:
+            date_to = st.date_input("To", key=f"{model}_date_to")
+
+    # stack of before_id cursors, one per visited page
+    cursor_key = f"{model}_history_cursors"
+    if st.session_state.get(f"{model}_history_filter") != (date_from, date_to):
+        st.session_state[f"{model}_history_filter"] = (date_from, date_to)
+        st.session_state[cursor_key] = [None]
+    cursors = st.session_state[cursor_key]
+
+    col_newer, col_older = st.columns(2)
+    with col_newer:
+        btn_newer = st.button("Newer", key=f"{model}_newer")
+    with col_older:
+        btn_older = st.button("Older", key=f"{model}_older")
+    if btn_newer and len(cursors) > 1:
+        cursors.pop()
+    try:
+        version = get_engine().version(model)
+        page = _cached_history(model, page_size, cursors[-1], date_from, date_to, version)
+        if btn_older and len(page) == page_size:
+            cursors.append(int(page["id"].iloc[-1]))
+            page = _cached_history(model, page_size, cursors[-1], date_from, date_to, version)
+        st.write(page)
+    except sqlite3.Error as error:
+        print("Failed to read from SQLite database", error)
 
 def get_id_db_log(columns: str, rowid: str, model: str) -> list:
     """Get an isolated row with selected columns from the model
@@ -479,18 +1586,7 @@ def get_id_db_log(columns: str, rowid: str, model: str) -> list:
     Returns:
         list: the row with selected columns
     """
-    try:
-        default_db_name = "main_database.db"
-        database = sqlite3.connect(default_db_name)
-        cur = database.cursor()
-
-        cur.execute(f'''SELECT {columns} FROM {model} WHERE id =='{rowid}' ''')
-        df_database = cur.fetchall()
-    except UnboundLocalError as error:
-        print("Database not created yes", error)
-
-    database.close()
-    return df_database
+    return get_engine().query(f"SELECT {columns} FROM {model} WHERE id == ?", (rowid,))
 
 
 def body_sidebar() -> str:
@@ -508,23 +1604,37 @@ def body_sidebar() -> str:
 
     if 'running_model' not in st.session_state:
         st.session_state['running_model'] = ""
-    if 'server_pid' not in st.session_state:
-        st.session_state['server_pid'] = 0
     ml_server = MLModel()
 
     btn_start_ml = st.sidebar.button("Start ML Model Server")
     btn_stop_ml = st.sidebar.button("Stop ML Model Server")
 
     if btn_start_ml:
-        if st.session_state['server_pid'] == 0:
-            ml_server.run_server()
-            st.session_state['server_pid'] = ml_server.serverprocess.pid
+        if ml_server.run_server():
+            with st.spinner("Starting ML Model Server"):
+                if not ml_server.wait_until_ready(120):
+                    st.sidebar.write("ML Model Server is not ready")
+        else:
+            st.sidebar.write("ML Model Server did not start, see run/ml_server.log")
     if btn_stop_ml:
-        if st.session_state['server_pid'] != 0:
-            ml_server.stop_server(st.session_state['server_pid'])
-            st.session_state['server_pid'] = 0
+        if not ml_server.stop_server():
+            st.sidebar.write("ML Model Server did not stop")
+        st.session_state['running_model'] = ""
 
-    st.sidebar.write(f"PID {str(st.session_state['server_pid'])}")
+    server_status = ml_server.server_status()
+    st.sidebar.write(f"PID {server_status['server_pid']}")
+    if server_status['restarts']:
+        st.sidebar.write(f"Restarted after {server_status['restarts']} crashes")
+    server_metrics = ml_server.server_metrics() if server_status['running'] else {}
+    if server_metrics:
+        with st.sidebar.expander("Server metrics"):
+            st.write(f"Requests {server_metrics['requests']}, errors {server_metrics['errors']}, "
+                     f"in flight {server_metrics['in_flight']}")
+            st.write(f"Mean latency {server_metrics['mean_latency_ms']} ms")
+            st.write(f"Text generation {server_metrics['tokens_per_second']} tokens/s")
+            st.write(f"Image decode {server_metrics['mean_image_decode_ms']} ms")
+            for model, memory in server_metrics['models_mb'].items():
+                st.write(f"{model}: {memory} MB")
     selected_ml_model = st.sidebar.selectbox("Select ML Model",
                                             ["question_answering",
                                             "text_generator",
@@ -539,24 +1649,48 @@ def body_image_class():
     """
     with st.expander("Image classes"):
         with st.form("ML Classes"):
-            image_class1 = st.text_input("Image Class 1: ")
-            image_class2 = st.text_input("Image Class 2: ")
-            image_class3 = st.text_input("Image Class 3: ")
+            image_classes = st.text_input("Image Classes (comma separated): ")
             submit_classes = st.form_submit_button("Submit Classes")
     if submit_classes:
-        st.session_state["image_classes"] = {"class_1": image_class1,
-                                             "class_2": image_class2,
-                                             "class_3": image_class3}
+        st.session_state["image_classes"] = [image_class.strip()
+                                             for image_class in image_classes.split(",")
+                                             if image_class.strip()]
+
+def body_similar_images(image_classifier: MLImageClassifier):
+    """Streamlit panel showing stored images close to the last classified
+       image or to a description
+    """
+    with st.expander("Similar images", True):
+        with st.form("Similar images"):
+            description = st.text_input("Describe an image (empty uses the last classified image)")
+            count = st.number_input("Images", min_value=1, max_value=20, value=5)
+            btn_search = st.form_submit_button("Search")
+        if not btn_search:
+            return
+        embedding, exclude = st.session_state.get("query_embedding", (None, None))
+        if description.strip():
+            embedding, exclude = image_classifier.text_embedding(description.strip()), None
+        if embedding is None:
+            st.write("Classify an image or describe one to search")
+            return
+        matches = get_index().search(decode_embedding(embedding), int(count), exclude)
+        if not matches:
+            st.write("No stored images with embeddings")
+            return
+        for column, match in zip(st.columns(len(matches)), matches):
+            with column:
+                st.image(get_engine().get_thumbnail(match["image_sha256"]),
+                         caption=f"{match['id']}: {match['filename']} ({match['score']:.2f})")
 
 def body_image_classifier():
     """Streamlit page for image classifier
-       tries to classify a picture between 3 different
+       tries to classify a picture between any number of
        classes. Either default or provided by user.
        also acesses database for using historical queries
     """
     image_classifier = MLImageClassifier()
     if 'image_classes' not in st.session_state:
-        st.session_state['image_classes'] = {}
+        st.session_state['image_classes'] = []
 
     if st.session_state['running_model'] != "image_classifier":
         st.session_state['running_model'] = image_classifier.start()
@@ -582,11 +1716,15 @@ def body_image_classifier():
         view_db_log("image_classifier")
 
     if btn_classify_table or btn_show_id:
-        file = get_id_db_log("image,filename,result",
+        file = get_id_db_log("image_sha256,filename,result,embedding",
                                 regenerate_id,
                                 "image_classifier")
         if file != []:
-            upload = file[0][0]
+            # the full image is only read when a result without embedding is classified again
+            if btn_classify_table and file[0][3] is None:
+                upload = get_engine().get_image(file[0][0])
+            else:
+                upload = get_engine().get_thumbnail(file[0][0])
         else:
             st.write("Database index out of range")
 
@@ -598,23 +1736,41 @@ def body_image_classifier():
                                                         st.session_state["image_classes"],
                                                         upload.name)
                 write_to_db(out)
-                result_dict = dict(image_classifier.response.json())
+                result = image_classifier.result
+                st.session_state["query_embedding"] = (out["embedding"], hashlib.sha256(file).hexdigest())
+            elif btn_classify_table and file[0][3] is not None:
+                out = image_classifier.classify_embedding(file[0][3],
+                                                          st.session_state["image_classes"],
+                                                          file[0][1],
+                                                          file[0][0])
+                write_to_db(out)
+                result = image_classifier.result
+                st.session_state["query_embedding"] = (file[0][3], file[0][0])
             elif btn_classify_table:
                 out = image_classifier.classify_image(upload,
                                                         st.session_state["image_classes"],
                                                         file[0][1])
                 write_to_db(out)
-                result_dict = dict(image_classifier.response.json())
+                result = image_classifier.result
+                st.session_state["query_embedding"] = (out["embedding"], file[0][0])
             elif btn_show_id:
-                result_dict = json.loads(file[0][2].replace("'", "\""))
-            best_match = sorted(result_dict, key=result_dict.get, reverse=True)[0]
-            st.text(f"From the classes the best match is: {best_match.capitalize()}")
-            st.text(f"with a probability of {round(float(result_dict[best_match])*100,1)}%")
-            st.text(f"From the classes: {str(result_dict.keys())[12:-2]}")
+                # stored results are the probabilities as the server sent them
+                result = Classification(json.loads(file[0][2]), file[0][3])
+                st.session_state["query_embedding"] = (file[0][3], file[0][0])
+            if result is None:
+                st.text("No connection to ml server")
+            else:
+                probabilities = result.probabilities
+                best_match = max(probabilities, key=probabilities.get)
+                st.text(f"From the classes the best match is: {best_match.capitalize()}")
+                st.text(f"with a probability of {round(probabilities[best_match]*100,1)}%")
+                st.text(f"From the classes: {', '.join(probabilities)}")
     with col2:
         if upload is not None:
             st.image(upload)
 
+    body_similar_images(image_classifier)
+
 def body_text_generator():
     """Streamlit page for text generator
        takes a text and tries to continue on it
@@ -638,21 +1794,25 @@ def body_text_generator():
         user_retrieve_button = st.button("Retrieve")
 
         if update_log_button:
-            database = sqlite3.connect("main_database.db")
-            database.commit()
-            database.close()
+            try:
+                get_engine().flush()
+            except sqlite3.Error as error:
+                st.error(f"Some results could not be saved: {error}")
         if user_retrieve_button:
             retrieved_value = get_id_db_log("result", user_retrieve, "text_generator")
             retrieved_value = json.loads(retrieved_value[0][0])
             st.write(retrieved_value["generated_text"])
 
     if text_generator_button:
-        user_result = text_generator.get_text_gen(user_input)
-        write_to_db(user_result)
-        text_generator.response.json()
-        duser_result = dict(text_generator.response.json())
-        st.success('Sucessfully generated text')
-        st.write(duser_result["generated_text"])
+        generated_text = st.empty()
+        streamed_text = user_input
+        for token in text_generator.stream_text_gen(user_input):
+            streamed_text += token
+            generated_text.write(streamed_text)
+        # the result is saved once the whole text is generated
+        if text_generator.out["result"] != "ConnectionError":
+            write_to_db(text_generator.out)
+            st.success('Sucessfully generated text')
 
 
 def body_sentiment_analysis():
@@ -671,7 +1831,7 @@ def body_sentiment_analysis():
         user_result = sentiment_analysis.analyse_sentiment(str(user_input))
         st.write(str(round(user_result["score"] * 100, 1)) + "%", user_result["result"])
         write_to_db(user_result)
-    if st.button("Click here to view data"):
+    with st.expander("Logged entries", False):
         view_db_log("sentiment_analysis")
     with st.form(key='Get data by ID'):
         user_id_input = st.text_input(label='Enter ID')
@@ -696,10 +1856,10 @@ def body_question_answering():
         submit_question_context = st.form_submit_button(label='Submit Question & Text')
     if submit_question_context:
         user_result = question_answering.question_answering(user_question, user_context)
-        rounded_score = int(float(user_result['score']) * 100+0.5)
+        rounded_score = int(user_result['score'] * 100+0.5)
         st.write(f"Answer: {user_result['result']} with {rounded_score}% certainty")
         write_to_db(user_result)
-    if st.button("Click here to view data"):
+    with st.expander("Logged entries", False):
         view_db_log("question_answering")
     with st.form(key='Get data by ID'):
         user_id_input = st.text_input(label='Enter ID')
@@ -710,6 +1870,6 @@ def body_question_answering():
                                   "question_answering")
         st.write(f"Text: {sql_list[0][0]}")
         st.write(f"Question: {sql_list[0][1]}")
-        rounded_score = int(float(sql_list[0][3]) * 100+0.5)
+        rounded_score = int(sql_list[0][3] * 100+0.5)
         st.write(f"Answer: {sql_list[0][2]} with {rounded_score}% certainty")
     pass